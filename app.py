@@ -1,14 +1,12 @@
 import streamlit as st
 import os
-import plotly.express as px
-import pandas as pd
-from src.db_utils import init_db, get_unprocessed_emails, update_email_result, get_prompts, update_prompt, get_all_emails
-from src.ingestion import fetch_emails_mock, fetch_emails_imap
-from src.processor import process_email_batch
+from src.db_utils import init_db, get_unprocessed_emails, update_email_result, get_prompts, update_prompt, get_all_emails, get_threads, get_dedup_stats, get_stale_emails, get_prompt_versions, get_inbox_context, get_email_context
+from src.ingestion import fetch_emails_mock, fetch_emails_imap, build_sources, sync_sources
+from src.processor import process_email_batch, reprocess_stale_batch, generate_drafts, start_draft_prefetch, REPLY_CATEGORIES
+from src.graph import DEFAULT_MAX_CONCURRENCY
+from src.rate_limit import call_with_retry, estimate_tokens
+from src.digest import get_digest_context, is_digest_stale, is_digest_refreshing, start_digest_refresh
 from src.styles import CUSTOM_CSS
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
 
 # Page Config
 st.set_page_config(page_title="Email Agent", page_icon="📧", layout="wide")
@@ -39,18 +37,45 @@ with st.sidebar:
             email_user = st.text_input("Email")
             email_pass = st.text_input("App Password", type="password")
             imap_server = st.text_input("IMAP Server", value="imap.gmail.com")
+            folders_input = st.text_input("Folders (comma-separated)", value="INBOX")
+            
+            # Extra mailboxes synced alongside the one entered above
+            if 'imap_accounts' not in st.session_state:
+                st.session_state.imap_accounts = []
+            if st.button("➕ Add Another Account"):
+                if email_user and email_pass:
+                    st.session_state.imap_accounts.append({"username": email_user, "password": email_pass, "server": imap_server})
+                    st.success(f"Added {email_user}. Enter the next account above.")
+                else:
+                    st.error("Please enter email and password.")
+            for idx, account in enumerate(st.session_state.imap_accounts):
+                col_acc, col_rm = st.columns([4, 1])
+                col_acc.caption(f"📬 {account['username']}")
+                if col_rm.button("✖", key=f"rm_account_{idx}"):
+                    st.session_state.imap_accounts.pop(idx)
+                    st.rerun()
             
             if st.button("Fetch from Gmail"):
-                if not email_user or not email_pass:
+                accounts = list(st.session_state.imap_accounts)
+                if email_user and email_pass and email_user not in [a['username'] for a in accounts]:
+                    accounts.append({"username": email_user, "password": email_pass, "server": imap_server})
+                folders = [f.strip() for f in folders_input.split(",") if f.strip()] or ["INBOX"]
+                
+                if not accounts:
                     st.error("Please enter email and password.")
                 else:
-                    try:
-                        with st.spinner("Connecting to Gmail..."):
-                            count = fetch_emails_imap(email_user, email_pass, imap_server, limit=fetch_limit)
-                        st.success(f"Successfully fetched {count} emails!")
+                    sources = build_sources(accounts, folders, limit=fetch_limit)
+                    with st.spinner(f"Syncing {len(sources)} mailbox folder(s)..."):
+                        statuses = sync_sources(sources)
+                    total_fetched = sum(s['fetched'] for s in statuses)
+                    failed = [s for s in statuses if s['state'] == "error"]
+                    for s in failed:
+                        st.error(f"Failed to fetch {s['account']} / {s['folder']}: {s['error']}")
+                    if not failed:
+                        st.success(f"Successfully fetched {total_fetched} emails!")
                         st.rerun()
-                    except Exception as e:
-                        st.error(f"Failed to fetch: {e}")
+                    elif total_fetched:
+                        st.warning(f"Fetched {total_fetched} emails from the remaining folders.")
 
         else: # OAuth
             st.info("Requires 'client_secret.json' in project root.")
@@ -116,6 +141,33 @@ with st.sidebar:
             else:
                 st.warning("Please enter an API Key.")
 
+    st.markdown("---")
+    st.write("**Retention**")
+    # Old processed mail moves to a compressed archive database; the inbox stays small and fast
+    from src.retention import run_retention, search_archive, restore_emails, get_archive_stats
+    archive_days = st.number_input("Archive emails older than (days)", min_value=1, value=180)
+    archive_categories = st.multiselect("Only these categories (empty = all)", ["Work", "Personal", "Spam", "Newsletter"])
+    archive_processed_only = st.checkbox("Only processed emails", value=True)
+    retention_policy = {"older_than_days": archive_days, "categories": archive_categories or None,
+                        "processed_only": archive_processed_only}
+    if st.button("🗄️ Archive Old Emails"):
+        stats = run_retention([retention_policy])
+        st.success(f"Archived {stats['archived']} emails, freed {stats['pages_freed']} pages.")
+        st.rerun()
+
+    archive_stats = get_archive_stats()
+    if archive_stats['emails']:
+        with st.expander(f"🔎 Search Archive ({archive_stats['emails']} emails, {archive_stats['bytes'] / 1024 / 1024:.1f} MB)"):
+            archive_query = st.text_input("Search archived emails")
+            search_bodies = st.checkbox("Also search bodies (slower)")
+            if archive_query:
+                for archived in search_archive(archive_query, search_body=search_bodies):
+                    st.write(f"**{archived['sender']}**: {archived['subject']}")
+                    st.caption(f"{archived['timestamp']} · {archived['category'] or 'Unprocessed'}")
+                    if st.button("↩️ Restore", key=f"restore_{archived['id']}"):
+                        restore_emails([archived['id']])
+                        st.rerun()
+
     st.markdown("---")
     st.write("**Danger Zone**")
     if st.button("🗑️ Delete All Emails"):
@@ -148,14 +200,21 @@ with tab1:
         processed = len([e for e in all_emails if e['is_processed']])
         action_items_count = sum([len(e['action_items']) for e in all_emails if e['action_items']])
         
-        m1, m2, m3, m4 = st.columns(4)
+        dedup_stats = get_dedup_stats()
+        
+        m1, m2, m3, m4, m5 = st.columns(5)
         m1.metric("Total Emails", total)
         m2.metric("Processed", processed)
         m3.metric("Action Items", action_items_count)
         m4.metric("Drafts Generated", len([e for e in all_emails if e['generated_draft']]))
+        m5.metric("Near-Duplicates", dedup_stats['duplicates'], f"{dedup_stats['dedup_ratio']:.0%} dedup ratio", delta_color="off")
         
         # Charts
         if processed > 0:
+            # Charting libraries load on first use, not on every cold start
+            import plotly.express as px
+            import pandas as pd
+
             df = pd.DataFrame(all_emails)
             # Filter only processed for charts
             df_proc = df[df['is_processed'] == True].copy()
@@ -229,6 +288,16 @@ with tab1:
         st.divider()
 
     col_act, col_stat = st.columns([1, 3])
+    with col_stat:
+        reuse_duplicates = st.checkbox("Reuse results for near-duplicate emails", value=False,
+                                       help="Only one email per cluster of near-identical emails (newsletters, receipts, alerts) is sent to the model; "
+                                            "the others copy its category, and its summary if they carry the same numbers, "
+                                            "without action items or a draft.")
+        max_parallel_calls = st.number_input("Max parallel model calls", min_value=1, max_value=32, value=DEFAULT_MAX_CONCURRENCY)
+        lazy_drafts = st.checkbox("Generate reply drafts on demand", value=False,
+                                  help="The agent only categorizes, extracts and summarizes; drafts are written when you ask for one.")
+        prefetch_drafts = st.checkbox(f"Prefetch drafts for {' / '.join(REPLY_CATEGORIES)} emails in the background", value=True,
+                                      disabled=not lazy_drafts)
     with col_act:
         if st.button("Run LangGraph Agent", type="primary"):
             unprocessed = get_unprocessed_emails()
@@ -241,7 +310,12 @@ with tab1:
                 if not emails_to_process:
                     st.warning("Please select at least one email to process.")
                 else:
-                    process_email_batch(emails_to_process)
+                    process_email_batch(emails_to_process, reuse_near_duplicates=reuse_duplicates, max_concurrency=max_parallel_calls,
+                                        lazy_drafts=lazy_drafts)
+                    if lazy_drafts and prefetch_drafts:
+                        start_draft_prefetch()
+                    # The chat digest catches up in the background
+                    start_digest_refresh()
                     # Clear selection after processing
                     st.session_state.selected_emails = []
                     st.rerun()
@@ -286,8 +360,33 @@ with tab1:
         with c2:
              if st.button("Load More Emails (IMAP)"):
                  st.warning("Use the Sidebar 'Fetch from Gmail' with a higher limit to load more.")
+
+        # Thread view: newest conversation first, messages inside a conversation oldest first
+        group_by_thread = st.toggle("🧵 Group by thread", key="group_by_thread")
+        display_emails = all_emails
+        thread_rows = {}
+        if group_by_thread:
+            thread_rows = get_threads()
+            thread_latest = {}
+            for e in all_emails:
+                tid = e.get('thread_id') or e['id']
+                thread_latest[tid] = max(thread_latest.get(tid, ''), e['timestamp'] or '')
+            display_emails = sorted(all_emails, key=lambda e: e['timestamp'] or '')
+            display_emails = sorted(display_emails, key=lambda e: (thread_latest[e.get('thread_id') or e['id']], e.get('thread_id') or e['id']), reverse=True)
+        previous_thread = None
                 
-        for email in all_emails:
+        for email in display_emails:
+            # Thread header before the first message of each multi-message conversation
+            thread_id = email.get('thread_id') or email['id']
+            if group_by_thread and thread_id != previous_thread:
+                thread = thread_rows.get(thread_id)
+                if thread and thread['message_count'] > 1:
+                    import html
+                    st.markdown(f"**🧵 {html.escape(thread['subject'] or '(no subject)')}** · {thread['message_count']} messages")
+                    if thread.get('summary'):
+                        st.caption(thread['summary'])
+            previous_thread = thread_id
+
             # Determine badge color
             cat_lower = str(email['category']).lower()
             badge_class = "badge-work" # default
@@ -319,6 +418,8 @@ with tab1:
             
             with col_content:
                 with st.expander(f"{'✅' if email['is_processed'] else '🆕'} {email['sender']}: {email['subject']}"):
+                    if email.get('account'):
+                        st.caption(f"📬 {email['account']} / {email['folder']}")
                     # Render HTML Body safely
                     import html
                     body_content = email['body']
@@ -364,6 +465,12 @@ with tab1:
                                 st.caption("Click the copy icon in the top right of the box above to copy to clipboard.")
                             elif "spam" in cat_lower:
                                 st.warning("Marked as Spam - No Reply Drafted")
+                            elif email['generated_draft'] is None:
+                                # Draft deferred at processing time; generated and cached on request
+                                if st.button("✍️ Generate Draft", key=f"draft_{email['id']}"):
+                                    with st.spinner("Drafting reply..."):
+                                        generate_drafts([email])
+                                    st.rerun()
 
 # Tab 2: Agent Brain (Moved from Tab 1)
 with tab2:
@@ -371,29 +478,46 @@ with tab2:
     st.write("Customize the prompts used by the agent nodes.")
     
     prompts = get_prompts()
+    prompt_versions = get_prompt_versions()
     
     col1, col2 = st.columns(2)
     
     with col1:
-        st.subheader("Categorizer Prompt")
+        st.subheader(f"Categorizer Prompt (v{prompt_versions.get('categorization', 1)})")
         cat_prompt = st.text_area("Instructions for Categorizer Node", value=prompts.get('categorization', ''), height=150)
         if st.button("Save Categorizer Prompt"):
             update_prompt('categorization', cat_prompt)
             st.success("Saved!")
 
-        st.subheader("Extractor Prompt")
+        st.subheader(f"Extractor Prompt (v{prompt_versions.get('extraction', 1)})")
         ext_prompt = st.text_area("Instructions for Extractor Node", value=prompts.get('extraction', ''), height=150)
         if st.button("Save Extractor Prompt"):
             update_prompt('extraction', ext_prompt)
             st.success("Saved!")
 
     with col2:
-        st.subheader("Auto-Reply Prompt")
+        st.subheader(f"Auto-Reply Prompt (v{prompt_versions.get('auto_reply', 1)})")
         rep_prompt = st.text_area("Instructions for Drafter Node", value=prompts.get('auto_reply', ''), height=400)
         if st.button("Save Auto-Reply Prompt"):
             update_prompt('auto_reply', rep_prompt)
             st.success("Saved!")
 
+    # Results produced by an older prompt version can be refreshed field by field
+    st.divider()
+    stale_emails = get_stale_emails()
+    if stale_emails:
+        stale_counts = {}
+        for e in stale_emails:
+            for field in e['stale_fields']:
+                stale_counts[field] = stale_counts.get(field, 0) + 1
+        st.info("Emails with results from an older prompt version: " + ", ".join(f"{field} ({count})" for field, count in stale_counts.items()))
+        if st.button("♻️ Reprocess Stale Fields"):
+            reprocess_stale_batch()
+            start_digest_refresh()
+            st.rerun()
+    else:
+        st.caption("All processed emails are up to date with the current prompts.")
+
 # Tab 3: Interactive Chat
 with tab3:
     st.header("Chat with your Email")
@@ -428,25 +552,37 @@ with tab3:
                 st.session_state.current_chat_id = current_id
 
             # Context Content Generation
-            if selected_option == "All Emails":
-                context_content = "Here is a summary of all emails in the inbox:\n\n"
-                for e in all_emails:
-                    # Enrich context with timestamp and metadata for better reasoning
-                    context_content += f"""
-                    - ID: {e['id']}
-                    - From: {e['sender']}
-                    - Subject: {e['subject']}
-                    - Date/Time: {e['timestamp']}
-                    - Category: {e['category']}
-                    - Summary: {e.get('summary', 'N/A')}
-                    - Action Items: {e.get('action_items', [])}
-                    - Body Snippet: {e['body'][:300]}...
-                    --------------------------------------------------
-                    """
+            use_digest = selected_option == "All Emails" and st.toggle("Answer from inbox digest", value=True, key="use_digest",
+                                                                       help="Uses precomputed per-day/per-category summaries instead of re-reading every email.")
+            unprocessed = [e for e in all_emails if not e['is_processed']]
+            unprocessed_note = ""
+            if unprocessed:
+                unprocessed_note = f"\n{len(unprocessed)} emails are not processed yet and not in the digest. Their subjects:\n"
+                unprocessed_note += "".join(f"- {e['timestamp']} | {e['sender']}: {e['subject']}\n" for e in unprocessed[:30])
+            if use_digest:
+                # The digest is refreshed in the background after processing runs; the chat
+                # answers from whatever is stored and says when that is behind
+                digest_context = get_digest_context()
+                if is_digest_stale():
+                    if not is_digest_refreshing():
+                        start_digest_refresh()
+                    st.caption("⏳ The inbox digest is being updated in the background; the latest processed emails may be missing.")
+                    if digest_context:
+                        digest_context += "Note: this digest is being updated; the most recently processed emails may be missing from it.\n"
+                if digest_context:
+                    context_content = digest_context + unprocessed_note
+                    st.info("Chatting with the inbox digest (per-day/per-category summaries).")
+                else:
+                    # No digest built yet: answer from all emails meanwhile
+                    context_content = get_inbox_context()
+                    st.info("Chatting with context from ALL emails until the inbox digest is ready.")
+            elif selected_option == "All Emails":
+                # Built once per inbox change and shared by every session
+                context_content = get_inbox_context()
                 st.info("Chatting with context from ALL emails.")
             else:
                 selected_email = email_options[selected_option]
-                context_content = f"From: {selected_email['sender']}\nSubject: {selected_email['subject']}\nBody:\n{selected_email['body']}"
+                context_content = get_email_context(selected_email['id'])
                 
                 st.markdown(f"""
                 <div class="email-card">
@@ -496,10 +632,18 @@ with tab3:
                     Question: {{question}}
                     """
                     
-                    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite", temperature=0)
+                    from langchain_google_genai import ChatGoogleGenerativeAI
+                    from langchain_core.prompts import ChatPromptTemplate
+                    from langchain_core.output_parsers import StrOutputParser
+
+                    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite", temperature=0, max_retries=0)
                     chat_prompt = ChatPromptTemplate.from_template(system_prompt)
                     chain = chat_prompt | llm | StrOutputParser()
-                    response = chain.invoke({"context": context_content, "question": prompt})
+                    # Shares the process-wide quota with batch processing; retries 429s with backoff
+                    response = call_with_retry(
+                        lambda: chain.invoke({"context": context_content, "question": prompt}),
+                        estimated_tokens=estimate_tokens(system_prompt + context_content + prompt)
+                    )
                     
                     st.markdown(response)
                     st.session_state.messages.append({"role": "assistant", "content": response})
@@ -0,0 +1,101 @@
+"""
+Import-time benchmark: measures cold-start latency of the app's modules.
+
+Each module is imported in a fresh interpreter several times and the median wall
+time is reported. With --record, results are appended to a JSONL history file so
+startup latency can be tracked over time (one line per run, tagged with the commit).
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --record benchmarks/import_times.jsonl
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = [
+    "src.db_utils",
+    "src.ingestion",
+    "src.graph",
+    "src.processor",
+    "src.digest",
+    "src.transfer",
+]
+
+def time_import(module: str, repeats: int) -> dict:
+    """Median/min wall time (ms) of `import module` in a fresh interpreter, minus interpreter startup."""
+    def run(code):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True, capture_output=True)
+        return (time.perf_counter() - started) * 1000
+
+    baseline = statistics.median(run("pass") for _ in range(repeats))
+    samples = [run(f"import {module}") - baseline for _ in range(repeats)]
+    return {"median_ms": round(statistics.median(samples), 1), "min_ms": round(min(samples), 1)}
+
+def _importtime(code: str) -> list:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=ROOT, capture_output=True, text=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            entries.append((int(parts[1]), parts[2].strip()))
+    return entries
+
+def heaviest_imports(module: str, top: int = 5) -> list:
+    """Top cumulative entries from `python -X importtime` for one module, excluding interpreter startup."""
+    startup = {name for _, name in _importtime("pass")}
+    entries = [(us, name) for us, name in _importtime(f"import {module}") if name not in startup]
+    return [{"module": name, "cumulative_ms": round(us / 1000, 1)} for us, name in sorted(entries, reverse=True)[:top]]
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Measure import-time (cold start) latency.")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--record", metavar="PATH", help="Append results to a JSONL history file")
+    parser.add_argument("--details", action="store_true", help="Show the heaviest nested imports per module")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for module in args.modules:
+        try:
+            results[module] = time_import(module, args.repeats)
+        except subprocess.CalledProcessError as e:
+            results[module] = {"error": e.stderr.decode(errors="replace").strip().splitlines()[-1]}
+        timing = results[module]
+        if "error" in timing:
+            print(f"{module:<20} ERROR {timing['error']}")
+        else:
+            print(f"{module:<20} median {timing['median_ms']:>8.1f} ms   min {timing['min_ms']:>8.1f} ms")
+        if args.details and "error" not in timing:
+            for entry in heaviest_imports(module):
+                print(f"    {entry['cumulative_ms']:>8.1f} ms  {entry['module']}")
+
+    if args.record:
+        record = {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "results": results,
+        }
+        with open(args.record, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"Recorded to {args.record}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
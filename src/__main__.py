@@ -0,0 +1,258 @@
+"""
+Headless entry point: runs the pipeline without Streamlit, e.g. from cron or a container job.
+
+    python -m src sync --mock
+    python -m src sync --accounts accounts.json --folders INBOX,[Gmail]/Updates
+    python -m src process --batch-size 10 --max-concurrency 4
+    python -m src run --accounts accounts.json --interval 900
+    python -m src export backup.jsonl
+
+Exit codes: 0 on success, 1 if any mailbox or batch failed, 2 on invalid usage.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+from .db_utils import init_db, get_unprocessed_emails
+from .transfer import DEFAULT_CHUNK_SIZE, EXPORT_FORMATS, IMPORT_FORMATS
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+
+class UsageError(Exception):
+    """Invalid arguments or missing configuration; reported with the usage text (exit code 2)."""
+
+def _load_accounts(args) -> List[Dict]:
+    """Accounts from --accounts (JSON list of {username, password, server}) and/or --user."""
+    accounts = []
+    if args.accounts:
+        with open(args.accounts, "r", encoding="utf-8") as f:
+            accounts.extend(json.load(f))
+    if args.user:
+        password = os.environ.get("EMAIL_AGENT_IMAP_PASSWORD")
+        if not password:
+            raise UsageError("--user requires the EMAIL_AGENT_IMAP_PASSWORD environment variable")
+        accounts.append({"username": args.user, "password": password, "server": args.server})
+    return accounts
+
+def _print_status(status: Dict):
+    if status['state'] == "error":
+        print(f"  {status['account']} / {status['folder']}: error after {status['elapsed']:.1f}s: {status['error']}")
+    elif status['state'] == "done":
+        print(f"  {status['account']} / {status['folder']}: {status['fetched']} emails in {status['elapsed']:.1f}s")
+
+def _processing_callbacks() -> Dict:
+    return {
+        "on_start": lambda batches, total: print(f"Processing {total} emails in {batches} batches..."),
+        "on_batch_done": lambda done, total: print(f"  {done}/{total} emails done"),
+        "on_error": lambda e: print(f"  Batch failed: {e}"),
+    }
+
+def cmd_sync(args) -> int:
+    from .ingestion import fetch_emails_mock, build_sources, sync_sources
+
+    if args.mock:
+        print(f"Loaded {fetch_emails_mock()} mock emails")
+        return EXIT_OK
+
+    accounts = _load_accounts(args)
+    if not accounts:
+        raise UsageError("sync needs --mock, --accounts or --user")
+    folders = [f.strip() for f in args.folders.split(",") if f.strip()]
+    sources = build_sources(accounts, folders, limit=args.limit)
+    print(f"Syncing {len(sources)} mailbox folder(s)...")
+    statuses = sync_sources(sources, max_connections=args.max_connections, on_progress=_print_status)
+    failed = [s for s in statuses if s['state'] == "error"]
+    print(f"Fetched {sum(s['fetched'] for s in statuses)} emails, {len(failed)} folder(s) failed")
+    return EXIT_FAILED if failed else EXIT_OK
+
+def cmd_process(args) -> int:
+    from .processor import process_emails, reprocess_stale_emails, prefetch_drafts
+
+    callbacks = _processing_callbacks()
+    options = {"batch_size": args.batch_size, "max_concurrency": args.max_concurrency}
+    if args.stale:
+        stats = reprocess_stale_emails(**options, **callbacks)
+    else:
+        emails = get_unprocessed_emails()
+        if args.max_emails:
+            emails = emails[:args.max_emails]
+        if not emails:
+            print("No new emails to process")
+            return EXIT_OK
+        stats = process_emails(emails, reuse_near_duplicates=args.reuse,
+                               lazy_drafts=args.lazy_drafts, **options, **callbacks)
+    print(f"Processed {stats['processed']} emails, reused {stats['reused']}, {stats['failed_batches']} batch(es) failed")
+
+    if args.prefetch_drafts:
+        draft_stats = prefetch_drafts(**options, **callbacks)
+        print(f"Drafted {draft_stats['processed']} replies, {draft_stats['failed_batches']} batch(es) failed")
+        stats['failed_batches'] += draft_stats['failed_batches']
+    return EXIT_FAILED if stats['failed_batches'] else EXIT_OK
+
+def cmd_run(args) -> int:
+    """sync followed by process, once or every --interval seconds."""
+    while True:
+        started = time.perf_counter()
+        try:
+            code = max(cmd_sync(args), cmd_process(args))
+        except UsageError:
+            raise
+        except Exception as e:
+            if not args.interval:
+                raise
+            # A scheduled run keeps going; the next cycle retries
+            print(f"Cycle failed: {e}")
+            code = EXIT_FAILED
+        print(f"Cycle finished in {time.perf_counter() - started:.1f}s (exit code {code})")
+        if not args.interval:
+            return code
+        time.sleep(max(args.interval - (time.perf_counter() - started), 0))
+
+def cmd_export(args) -> int:
+    from .transfer import export_emails, detect_format
+
+    if detect_format(args.path, args.format) not in EXPORT_FORMATS:
+        raise UsageError(f"cannot export to {args.path}; use --format with one of {', '.join(EXPORT_FORMATS)}")
+    count = export_emails(args.path, args.format, chunk_size=args.chunk_size,
+                          processed_only=args.processed_only, include_body=not args.no_body)
+    print(f"Exported {count} emails to {args.path}")
+    return EXIT_OK
+
+def cmd_import(args) -> int:
+    from .transfer import import_emails, detect_format
+
+    if detect_format(args.path, args.format) not in IMPORT_FORMATS:
+        raise UsageError(f"cannot import {args.path}; use --format with one of {', '.join(IMPORT_FORMATS)}")
+    count = import_emails(args.path, args.format, chunk_size=args.chunk_size)
+    print(f"Imported {count} emails from {args.path}")
+    return EXIT_OK
+
+def cmd_archive(args) -> int:
+    from .retention import run_retention, DEFAULT_POLICIES
+
+    policies = DEFAULT_POLICIES
+    if args.older_than_days:
+        policies = [{"older_than_days": args.older_than_days, "categories": args.category or None,
+                     "processed_only": not args.include_unprocessed}]
+    stats = run_retention(policies, dry_run=args.dry_run)
+    if args.dry_run:
+        print(f"{stats['matched']} emails would be archived")
+    else:
+        print(f"Archived {stats['archived']} emails, freed {stats['pages_freed']} pages")
+    return EXIT_OK
+
+def cmd_digest(args) -> int:
+    from .digest import refresh_digests
+
+    stats = refresh_digests(on_progress=lambda n, total: print(f"  {n}/{total} buckets"))
+    print(f"Refreshed {stats['refreshed']} of {stats['buckets']} day digests and {stats['months_refreshed']} month digests")
+    return EXIT_OK
+
+def cmd_listen(args) -> int:
+    from .idle import start_push_pipeline
+
+    accounts = _load_accounts(args)
+    if not accounts:
+        raise UsageError("listen needs --accounts or --user")
+    folders = [f.strip() for f in args.folders.split(",") if f.strip()]
+    sources = [{**account, "folder": folder} for account in accounts for folder in folders]
+    listeners, worker = start_push_pipeline(sources, process=not args.no_process)
+    print(f"Listening on {len(listeners)} mailbox folder(s), Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for thread in listeners + ([worker] if worker else []):
+            thread.stop()
+    return EXIT_OK
+
+def _add_account_arguments(parser):
+    parser.add_argument("--accounts", metavar="PATH", help="JSON file with a list of {username, password, server}")
+    parser.add_argument("--user", help="Single IMAP account; password read from EMAIL_AGENT_IMAP_PASSWORD")
+    parser.add_argument("--server", default="imap.gmail.com")
+    parser.add_argument("--folders", default="INBOX", help="Comma-separated folders")
+
+def _add_sync_arguments(parser):
+    parser.add_argument("--mock", action="store_true", help="Load the mock inbox instead of IMAP")
+    _add_account_arguments(parser)
+    parser.add_argument("--limit", type=int, default=10, help="Emails fetched per folder")
+    parser.add_argument("--max-connections", type=int, default=4)
+
+def _add_process_arguments(parser):
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--max-concurrency", type=int, help="Max parallel model calls")
+    parser.add_argument("--max-emails", type=int, help="Process at most this many emails")
+    parser.add_argument("--reuse", action="store_true", help="Copy category (and summary, if the numbers match) to near-duplicates")
+    parser.add_argument("--lazy-drafts", action="store_true", help="Skip drafts; generate them on demand later")
+    parser.add_argument("--prefetch-drafts", action="store_true", help="Then draft replies for Work/Personal emails")
+    parser.add_argument("--stale", action="store_true", help="Regenerate fields made by older prompt versions")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m src", description="Run the email agent without the UI.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = subparsers.add_parser("sync", help="Fetch emails into the database")
+    _add_sync_arguments(sync_parser)
+    sync_parser.set_defaults(handler=cmd_sync)
+
+    process_parser = subparsers.add_parser("process", help="Run the agent on unprocessed emails")
+    _add_process_arguments(process_parser)
+    process_parser.set_defaults(handler=cmd_process)
+
+    run_parser = subparsers.add_parser("run", help="sync then process, optionally on a schedule")
+    _add_sync_arguments(run_parser)
+    _add_process_arguments(run_parser)
+    run_parser.add_argument("--interval", type=int, help="Repeat every N seconds instead of running once")
+    run_parser.set_defaults(handler=cmd_run)
+
+    export_parser = subparsers.add_parser("export", help="Export emails and results to JSONL or Parquet")
+    export_parser.add_argument("path")
+    export_parser.add_argument("--format", choices=EXPORT_FORMATS)
+    export_parser.add_argument("--processed-only", action="store_true")
+    export_parser.add_argument("--no-body", action="store_true", help="Leave email bodies out of the export")
+    export_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    export_parser.set_defaults(handler=cmd_export)
+
+    import_parser = subparsers.add_parser("import", help="Import a JSONL or mbox dump")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=IMPORT_FORMATS)
+    import_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    import_parser.set_defaults(handler=cmd_import)
+
+    archive_parser = subparsers.add_parser("archive", help="Move old emails to the archive database")
+    archive_parser.add_argument("--older-than-days", type=int, help="Use this policy instead of the defaults")
+    archive_parser.add_argument("--category", action="append", help="Limit the policy to a category (repeatable)")
+    archive_parser.add_argument("--include-unprocessed", action="store_true")
+    archive_parser.add_argument("--dry-run", action="store_true")
+    archive_parser.set_defaults(handler=cmd_archive)
+
+    digest_parser = subparsers.add_parser("digest", help="Refresh the inbox digest used by the chat")
+    digest_parser.set_defaults(handler=cmd_digest)
+
+    listen_parser = subparsers.add_parser("listen", help="Push mode: IMAP IDLE listeners plus processing")
+    _add_account_arguments(listen_parser)
+    listen_parser.add_argument("--no-process", action="store_true", help="Only save new emails")
+    listen_parser.set_defaults(handler=cmd_listen)
+    return parser
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    init_db()
+    started = time.perf_counter()
+    try:
+        code = args.handler(args)
+    except UsageError as e:
+        parser.error(str(e))
+    except Exception as e:
+        print(f"{args.command} failed: {e}")
+        code = EXIT_FAILED
+    print(f"{args.command} finished in {time.perf_counter() - started:.1f}s")
+    return code
+
+if __name__ == "__main__":
+    sys.exit(main())
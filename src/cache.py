@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+# Entries kept across all scopes; least recently used entries are dropped first
+MAX_ENTRIES = 512
+
+def _copy(value: Any) -> Any:
+    """Copies the containers of a cached value so callers can mutate what they get."""
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+class SharedCache:
+    """
+    Process-wide cache shared by every session of the app. Each entry remembers the
+    change counter of the data it was computed from; a lookup with a newer counter
+    recomputes it. Values are copied on the way in and out.
+    """
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key: Hashable, version: int, compute: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _copy(entry[1])
+            self.misses += 1
+
+        # Computed outside the lock so slow queries do not block other lookups
+        value = compute()
+        with self._lock:
+            self._entries[key] = (version, _copy(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+_shared_cache = SharedCache()
+
+def get_shared_cache() -> SharedCache:
+    return _shared_cache
@@ -1,6 +1,9 @@
 import sqlite3
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional, Iterator
+from .threads import parse_message_ids, normalize_subject
+from .dedup import index_email, SIGNATURE_VERSION
+from .cache import get_shared_cache
 
 DB_PATH = "email_agent.db"
 
@@ -10,15 +13,72 @@ DEFAULT_PROMPTS = {
     "auto_reply": "Draft a polite and professional reply to this email. Keep it concise. IMPORTANT: Do NOT draft a reply if the sender address contains 'noreply' or 'no-reply'. In that case, return 'N/A'."
 }
 
+# Which prompt each result field is generated from; results record the prompt version they used
+FIELD_PROMPTS = {
+    "category": "categorization",
+    "action_items": "extraction",
+    "generated_draft": "auto_reply",
+}
+
+def _version_column(prompt_name: str) -> str:
+    return f"{prompt_name}_version"
+
+# Change-counter scopes: every write bumps the counter of the data it touches, and
+# cached reads of that data are recomputed once their counter has moved on
+EMAILS_SCOPE = "emails"     # emails, threads, near-duplicate index
+PROMPTS_SCOPE = "prompts"
+DIGESTS_SCOPE = "digests"
+
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    # Generous busy timeout: ingestion workers write concurrently
+    conn = sqlite3.connect(DB_PATH, timeout=30)
     conn.row_factory = sqlite3.Row
     return conn
 
+def _ensure_columns(cursor, table: str, columns: Dict[str, str]):
+    """Adds columns missing from databases created by older versions of the app."""
+    cursor.execute(f'PRAGMA table_info({table})')
+    existing = {row['name'] for row in cursor.fetchall()}
+    for name, column_type in columns.items():
+        if name not in existing:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+def bump_change_counter(cursor, scope: str):
+    """Marks data in a scope as changed; call inside the writing transaction."""
+    cursor.execute('''
+        INSERT INTO meta (key, value) VALUES (?, 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+    ''', (f"{scope}_changes",))
+
+def get_change_counter(scope: str) -> int:
+    """Current change counter of a scope (0 for a database that was never written)."""
+    conn = get_db_connection()
+    try:
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (f"{scope}_changes",)).fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    conn.close()
+    return row['value'] if row else 0
+
+def cached_query(scope: str, key, compute):
+    """Serves a read from the shared cache until a write bumps the scope's change counter."""
+    return get_shared_cache().get_or_compute((DB_PATH, scope, key), get_change_counter(scope), compute)
+
 def init_db():
     """Initialize the database with tables and default prompts."""
     conn = get_db_connection()
     cursor = conn.cursor()
+    # Lets retention hand space back with PRAGMA incremental_vacuum (only takes effect on a new file)
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    # Change counters for the shared cache
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    ''')
+    emails_changed = False
 
     # Emails table
     cursor.execute('''
@@ -36,6 +96,90 @@ def init_db():
             is_processed BOOLEAN DEFAULT 0
         )
     ''')
+    _ensure_columns(cursor, 'emails', {
+        'message_id': 'TEXT',
+        'in_reply_to': 'TEXT',
+        'references_header': 'TEXT',
+        'thread_id': 'TEXT',
+        'account': 'TEXT',
+        'folder': 'TEXT',
+        **{_version_column(prompt_name): 'INTEGER' for prompt_name in FIELD_PROMPTS.values()},
+    })
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_message_id ON emails (message_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_emails_thread_id ON emails (thread_id)')
+
+    # Threads table (one row per conversation, with a rolling summary)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS threads (
+            thread_id TEXT PRIMARY KEY,
+            subject TEXT,
+            summary TEXT,
+            message_count INTEGER DEFAULT 0,
+            last_timestamp TEXT
+        )
+    ''')
+
+    # Emails stored before threading existed become single-message threads
+    cursor.execute('UPDATE emails SET thread_id = id WHERE thread_id IS NULL')
+    emails_changed = cursor.rowcount > 0
+    cursor.execute('''
+        INSERT OR IGNORE INTO threads (thread_id, subject, message_count, last_timestamp)
+        SELECT thread_id, MIN(subject), COUNT(*), MAX(timestamp) FROM emails GROUP BY thread_id
+    ''')
+
+    # Near-duplicate index (SimHash signatures and their bands for lookup)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_signatures (
+            email_id TEXT PRIMARY KEY,
+            simhash INTEGER,
+            cluster_id TEXT
+        )
+    ''')
+    _ensure_columns(cursor, 'email_signatures', {'template_key': 'TEXT'})
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS signature_bands (
+            band INTEGER,
+            value INTEGER,
+            email_id TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_signature_bands ON signature_bands (band, value)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_email_signatures_cluster ON email_signatures (cluster_id)')
+    # Signatures computed differently are rebuilt below
+    cursor.execute("SELECT value FROM meta WHERE key = 'signature_version'")
+    row = cursor.fetchone()
+    if not row or row['value'] != SIGNATURE_VERSION:
+        cursor.execute('DELETE FROM email_signatures')
+        cursor.execute('DELETE FROM signature_bands')
+        cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('signature_version', ?)", (SIGNATURE_VERSION,))
+
+    # Index emails stored before near-duplicate detection existed
+    cursor.execute('''
+        SELECT id, sender, subject, body FROM emails
+        WHERE id NOT IN (SELECT email_id FROM email_signatures)
+        ORDER BY timestamp ASC
+    ''')
+    for row in cursor.fetchall():
+        index_email(cursor, dict(row))
+        emails_changed = True
+
+    # IDs of emails moved to the archive database, so fetching them again does not re-insert them
+    cursor.execute('CREATE TABLE IF NOT EXISTS archived_ids (id TEXT PRIMARY KEY)')
+
+    # Inbox digests: per day/category summaries and their per-month rollups
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS digests (
+            level TEXT,
+            period TEXT,
+            category TEXT,
+            summary TEXT,
+            action_items TEXT,
+            email_count INTEGER,
+            fingerprint TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (level, period, category)
+        )
+    ''')
 
     # Prompts table
     cursor.execute('''
@@ -44,27 +188,110 @@ def init_db():
             prompt_text TEXT
         )
     ''')
+    _ensure_columns(cursor, 'prompts', {'version': 'INTEGER DEFAULT 1'})
+
+    # Results stored before prompt versioning are treated as produced by version 1
+    # (fields never generated, e.g. drafts deferred to on-demand generation, stay unversioned)
+    for field, prompt_name in FIELD_PROMPTS.items():
+        column = _version_column(prompt_name)
+        cursor.execute(f'UPDATE emails SET {column} = 1 WHERE is_processed = 1 AND {column} IS NULL AND {field} IS NOT NULL')
+        emails_changed = emails_changed or cursor.rowcount > 0
 
     # Insert default prompts if not exist
+    prompts_added = False
     for name, text in DEFAULT_PROMPTS.items():
         cursor.execute('INSERT OR IGNORE INTO prompts (name, prompt_text) VALUES (?, ?)', (name, text))
+        prompts_added = prompts_added or cursor.rowcount > 0
 
+    # Only real changes invalidate caches; init_db also runs for every new UI session
+    if emails_changed:
+        bump_change_counter(cursor, EMAILS_SCOPE)
+    if prompts_added:
+        bump_change_counter(cursor, PROMPTS_SCOPE)
     conn.commit()
     conn.close()
 
-def save_emails(emails: List[Dict]):
-    """Save a list of emails to the database."""
+def _resolve_thread_id(cursor, email: Dict) -> str:
+    """Finds the thread an email belongs to from its In-Reply-To / References headers."""
+    related_ids = parse_message_ids(email.get('references')) + parse_message_ids(email.get('in_reply_to'))
+    if related_ids:
+        placeholders = ','.join('?' * len(related_ids))
+        cursor.execute(f'''
+            SELECT thread_id FROM emails
+            WHERE message_id IN ({placeholders}) AND thread_id IS NOT NULL
+            LIMIT 1
+        ''', related_ids)
+        row = cursor.fetchone()
+        if row:
+            return row['thread_id']
+        # Parent not stored (yet): the first reference is the root of the conversation
+        return related_ids[0]
+    return email.get('message_id') or email['id']
+
+def _adopt_legacy_email(cursor, email: Dict) -> bool:
+    """
+    Older versions stored IMAP emails under their bare UID, without account or folder.
+    When such an email is fetched again under its namespaced ID, the stored row (and its
+    processing results) is renamed instead of the email being inserted a second time.
+    """
+    if not email.get('account') or not email.get('message_id'):
+        return False
+    legacy_id = email['id'].rsplit(':', 1)[-1]
+    cursor.execute('''
+        UPDATE emails SET id = ?, account = ?, folder = ?
+        WHERE id = ? AND message_id = ? AND account IS NULL
+    ''', (email['id'], email['account'], email.get('folder'), legacy_id, email['message_id']))
+    if cursor.rowcount != 1:
+        return False
+    cursor.execute('UPDATE email_signatures SET email_id = ? WHERE email_id = ?', (email['id'], legacy_id))
+    cursor.execute('UPDATE email_signatures SET cluster_id = ? WHERE cluster_id = ?', (email['id'], legacy_id))
+    cursor.execute('UPDATE signature_bands SET email_id = ? WHERE email_id = ?', (email['id'], legacy_id))
+    return True
+
+def save_emails(emails: List[Dict]) -> int:
+    """
+    Save a list of emails to the database, assigning each one to a thread.
+    Returns how many new emails were stored; ones already stored or archived are skipped.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    for email in emails:
+    changed = False
+    inserted = 0
+    # Oldest first so parents are stored before their replies
+    for email in sorted(emails, key=lambda e: e.get('timestamp') or ''):
+        if _adopt_legacy_email(cursor, email):
+            changed = True
+            continue
+        if cursor.execute('SELECT 1 FROM archived_ids WHERE id = ?', (email['id'],)).fetchone():
+            # Archived already; restore_emails brings it back
+            continue
+        thread_id = _resolve_thread_id(cursor, email)
         cursor.execute('''
-            INSERT OR IGNORE INTO emails (id, sender, subject, body, timestamp, image_url)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (email['id'], email['sender'], email['subject'], email['body'], email['timestamp'], email.get('image_url')))
-        
+            INSERT OR IGNORE INTO emails (id, sender, subject, body, timestamp, image_url,
+                                          message_id, in_reply_to, references_header, thread_id, account, folder)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (email['id'], email['sender'], email['subject'], email['body'], email['timestamp'], email.get('image_url'),
+              email.get('message_id'), email.get('in_reply_to'), email.get('references'), thread_id,
+              email.get('account'), email.get('folder')))
+
+        if cursor.rowcount == 1:
+            cursor.execute('''
+                INSERT INTO threads (thread_id, subject, message_count, last_timestamp)
+                VALUES (?, ?, 1, ?)
+                ON CONFLICT(thread_id) DO UPDATE SET
+                    message_count = message_count + 1,
+                    last_timestamp = MAX(COALESCE(last_timestamp, ''), excluded.last_timestamp)
+            ''', (thread_id, normalize_subject(email['subject']), email['timestamp']))
+            index_email(cursor, email)
+            changed = True
+            inserted += 1
+
+    if changed:
+        bump_change_counter(cursor, EMAILS_SCOPE)
     conn.commit()
     conn.close()
+    return inserted
 
 def get_unprocessed_emails() -> List[Dict]:
     """Fetch emails that haven't been processed yet."""
@@ -81,20 +308,190 @@ def get_unprocessed_emails() -> List[Dict]:
         emails.append(email)
     return emails
 
-def update_email_result(email_id: str, category: str, action_items: List[str], draft: str, summary: str = ""):
-    """Update email with processing results."""
+def get_emails_by_ids(email_ids: List[str], unprocessed_only: bool = False) -> List[Dict]:
+    """Fetch specific emails, optionally only those that haven't been processed yet."""
+    if not email_ids:
+        return []
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE emails 
-        SET category = ?, action_items = ?, generated_draft = ?, summary = ?, is_processed = 1
-        WHERE id = ?
-    ''', (category, json.dumps(action_items), draft, summary, email_id))
+    placeholders = ','.join('?' * len(email_ids))
+    query = f'SELECT * FROM emails WHERE id IN ({placeholders})'
+    if unprocessed_only:
+        query += ' AND is_processed = 0'
+    cursor.execute(query, list(email_ids))
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+RESULT_UPDATE_SQL = '''
+    UPDATE emails
+    SET category = ?, action_items = ?, generated_draft = ?, summary = ?, is_processed = 1,
+        categorization_version = ?, extraction_version = ?, auto_reply_version = ?
+    WHERE id = ?
+'''
+
+def _result_params(email_id: str, category: str, action_items: List[str], draft: Optional[str], summary: str,
+                   prompt_versions: Dict[str, int]) -> tuple:
+    return (category, json.dumps(action_items), draft, summary,
+            prompt_versions.get('categorization'), prompt_versions.get('extraction'),
+            prompt_versions.get('auto_reply') if draft is not None else None,
+            email_id)
+
+def _field_assignments(fields: Dict, prompt_versions: Dict[str, int]):
+    """SET clauses (and params) updating some result fields along with their prompt versions."""
+    assignments = []
+    params = []
+    for field, value in fields.items():
+        if field not in ("category", "action_items", "generated_draft", "summary"):
+            raise ValueError(f"Unknown result field: {field}")
+        assignments.append(f"{field} = ?")
+        params.append(json.dumps(value) if field == "action_items" else value)
+        if field in FIELD_PROMPTS:
+            assignments.append(f"{_version_column(FIELD_PROMPTS[field])} = ?")
+            params.append(prompt_versions.get(FIELD_PROMPTS[field]))
+    return assignments, params
+
+def update_email_result(email_id: str, category: str, action_items: List[str], draft: Optional[str], summary: str = "",
+                        prompt_versions: Optional[Dict[str, int]] = None):
+    """
+    Update email with processing results, recording which prompt versions produced them.
+    A draft of None means it was not generated yet (on-demand drafts).
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(RESULT_UPDATE_SQL, _result_params(email_id, category, action_items, draft, summary, prompt_versions or {}))
+    bump_change_counter(cursor, EMAILS_SCOPE)
     conn.commit()
     conn.close()
 
+def save_batch_results(results: Dict[str, Dict], prompt_versions: Optional[Dict[str, int]] = None, partial: bool = False,
+                       thread_summaries: Optional[Dict[str, str]] = None) -> int:
+    """
+    Store the results of one agent batch (email ID -> result fields) and its updated thread
+    summaries in a single transaction. With partial, only the fields present are updated.
+    Returns the number of emails updated.
+    """
+    prompt_versions = prompt_versions or {}
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if partial:
+        for email_id, fields in results.items():
+            assignments, params = _field_assignments(fields, prompt_versions)
+            if assignments:
+                cursor.execute(f'UPDATE emails SET {", ".join(assignments)} WHERE id = ?', params + [email_id])
+    else:
+        cursor.executemany(RESULT_UPDATE_SQL, [
+            _result_params(email_id, res.get('category', 'Uncategorized'), res.get('action_items', []),
+                           # None when drafts are deferred to on-demand generation
+                           res.get('generated_draft'), res.get('summary', ''), prompt_versions)
+            for email_id, res in results.items()
+        ])
+    if thread_summaries:
+        cursor.executemany('UPDATE threads SET summary = ? WHERE thread_id = ?',
+                           [(summary, thread_id) for thread_id, summary in thread_summaries.items()])
+    bump_change_counter(cursor, EMAILS_SCOPE)
+    conn.commit()
+    conn.close()
+    return len(results)
+
+def update_email_results(results: List[Dict]):
+    """Store processing results for many emails in one transaction (e.g. when importing a backup)."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany(RESULT_UPDATE_SQL, [
+        _result_params(r['id'], r.get('category'), r.get('action_items') or [], r.get('generated_draft'), r.get('summary'), {
+            # Results without a recorded version count as version 1, like pre-versioning rows
+            'categorization': r.get('categorization_version') or 1,
+            'extraction': r.get('extraction_version') or 1,
+            'auto_reply': r.get('auto_reply_version') or 1
+        })
+        for r in results
+    ])
+    bump_change_counter(cursor, EMAILS_SCOPE)
+    conn.commit()
+    conn.close()
+
+def iter_emails(chunk_size: int = 500, processed_only: bool = False) -> Iterator[List[Dict]]:
+    """Stream emails in chunks without loading the whole table into memory."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        query = 'SELECT * FROM emails'
+        if processed_only:
+            query += ' WHERE is_processed = 1'
+        # rowid order streams straight off the table without a sort
+        cursor.execute(query + ' ORDER BY rowid')
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = []
+            for row in rows:
+                email = dict(row)
+                try:
+                    email['action_items'] = json.loads(email['action_items']) if email['action_items'] else []
+                except Exception:
+                    email['action_items'] = []
+                chunk.append(email)
+            yield chunk
+    finally:
+        conn.close()
+
+def get_stale_emails() -> List[Dict]:
+    """
+    Fetch processed emails with fields generated by an older version of their prompt.
+    Each email gets a 'stale_fields' list naming the fields to regenerate.
+    Fields not generated yet (pending on-demand drafts) are not stale.
+    """
+    # Depends on emails and prompts alike: the prompts counter is part of the key
+    return cached_query(EMAILS_SCOPE, ("stale_emails", get_change_counter(PROMPTS_SCOPE)), _load_stale_emails)
+
+def _load_stale_emails() -> List[Dict]:
+    versions = get_prompt_versions()
+    conditions = ' OR '.join(
+        f'({field} IS NOT NULL AND COALESCE({_version_column(prompt_name)}, 0) < ?)'
+        for field, prompt_name in FIELD_PROMPTS.items()
+    )
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT * FROM emails WHERE is_processed = 1 AND ({conditions})',
+                   [versions.get(prompt_name, 1) for prompt_name in FIELD_PROMPTS.values()])
+    rows = cursor.fetchall()
+    conn.close()
+
+    emails = []
+    for row in rows:
+        email = dict(row)
+        email['stale_fields'] = [
+            field for field, prompt_name in FIELD_PROMPTS.items()
+            if email[field] is not None and (email[_version_column(prompt_name)] or 0) < versions.get(prompt_name, 1)
+        ]
+        emails.append(email)
+    return emails
+
+def get_pending_draft_emails(categories: Optional[List[str]] = None, limit: Optional[int] = None) -> List[Dict]:
+    """Fetch processed emails whose draft has not been generated yet, optionally only some categories."""
+    query = 'SELECT * FROM emails WHERE is_processed = 1 AND generated_draft IS NULL'
+    params = []
+    if categories:
+        query += f' AND category IN ({",".join("?" * len(categories))})'
+        params.extend(categories)
+    query += ' ORDER BY timestamp DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
 def get_prompts() -> Dict[str, str]:
-    """Fetch all prompts."""
+    """Fetch all prompts (served from the shared cache until a prompt changes)."""
+    return cached_query(PROMPTS_SCOPE, "prompts", _load_prompts)
+
+def _load_prompts() -> Dict[str, str]:
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM prompts')
@@ -102,38 +499,214 @@ def get_prompts() -> Dict[str, str]:
     conn.close()
     return {row['name']: row['prompt_text'] for row in rows}
 
+def get_prompt_versions() -> Dict[str, int]:
+    """Fetch the current version number of each prompt."""
+    return cached_query(PROMPTS_SCOPE, "prompt_versions", _load_prompt_versions)
+
+def _load_prompt_versions() -> Dict[str, int]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT name, version FROM prompts')
+    rows = cursor.fetchall()
+    conn.close()
+    return {row['name']: row['version'] or 1 for row in rows}
+
 def update_prompt(name: str, new_text: str):
-    """Update a specific prompt."""
+    """Update a specific prompt, bumping its version if the text changed."""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute('UPDATE prompts SET prompt_text = ? WHERE name = ?', (new_text, name))
+    cursor.execute('''
+        UPDATE prompts SET prompt_text = ?, version = COALESCE(version, 1) + 1
+        WHERE name = ? AND prompt_text IS NOT ?
+    ''', (new_text, name, new_text))
+    if cursor.rowcount:
+        bump_change_counter(cursor, PROMPTS_SCOPE)
     conn.commit()
     conn.close()
 
+def _parse_email_row(row) -> Dict:
+    email = dict(row)
+    if email['action_items']:
+        try:
+            email['action_items'] = json.loads(email['action_items'])
+        except Exception:
+            email['action_items'] = []
+    return email
+
 def get_all_emails() -> List[Dict]:
-    """Fetch all emails for display."""
+    """Fetch all emails for display (shared by every session until the emails change)."""
+    return cached_query(EMAILS_SCOPE, "all_emails", _load_all_emails)
+
+def _load_all_emails() -> List[Dict]:
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM emails ORDER BY timestamp DESC, id ASC')
     rows = cursor.fetchall()
     conn.close()
-    
-    emails = []
+    return [_parse_email_row(row) for row in rows]
+
+def get_email(email_id: str) -> Optional[Dict]:
+    """Fetch one email with its results (cached like get_all_emails)."""
+    def load():
+        conn = get_db_connection()
+        row = conn.execute('SELECT * FROM emails WHERE id = ?', (email_id,)).fetchone()
+        conn.close()
+        return _parse_email_row(row) if row else None
+    return cached_query(EMAILS_SCOPE, ("email", email_id), load)
+
+def get_inbox_context() -> str:
+    """Full-inbox chat context (every email with its results and a body snippet), cached until the emails change."""
+    return cached_query(EMAILS_SCOPE, "inbox_context", _build_inbox_context)
+
+def _build_inbox_context() -> str:
+    context = "Here is a summary of all emails in the inbox:\n\n"
+    for e in get_all_emails():
+        # Enrich context with timestamp and metadata for better reasoning
+        context += f"""
+        - ID: {e['id']}
+        - From: {e['sender']}
+        - Subject: {e['subject']}
+        - Date/Time: {e['timestamp']}
+        - Category: {e['category']}
+        - Summary: {e.get('summary', 'N/A')}
+        - Action Items: {e.get('action_items', [])}
+        - Body Snippet: {e['body'][:300]}...
+        --------------------------------------------------
+        """
+    return context
+
+def get_email_context(email_id: str) -> str:
+    """Chat context for a single email."""
+    email = get_email(email_id)
+    if not email:
+        return ""
+    return f"From: {email['sender']}\nSubject: {email['subject']}\nBody:\n{email['body']}"
+
+def get_threads(thread_ids: Optional[List[str]] = None) -> Dict[str, Dict]:
+    """Fetch thread rows (subject, rolling summary, message count), keyed by thread ID."""
+    if thread_ids is None:
+        # The full listing is what the inbox thread view asks for on every rerun
+        return cached_query(EMAILS_SCOPE, "all_threads", lambda: _load_threads(None))
+    return _load_threads(thread_ids)
+
+def _load_threads(thread_ids: Optional[List[str]]) -> Dict[str, Dict]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    if thread_ids is None:
+        cursor.execute('SELECT * FROM threads')
+    else:
+        thread_ids = list(thread_ids)
+        if not thread_ids:
+            conn.close()
+            return {}
+        placeholders = ','.join('?' * len(thread_ids))
+        cursor.execute(f'SELECT * FROM threads WHERE thread_id IN ({placeholders})', thread_ids)
+    rows = cursor.fetchall()
+    conn.close()
+    return {row['thread_id']: dict(row) for row in rows}
+
+def get_thread_email_summaries(thread_ids: List[str], exclude_ids: List[str]) -> Dict[str, List[Dict]]:
+    """Summaries of the processed messages of some threads, oldest first, keyed by thread ID."""
+    thread_ids = list(thread_ids)
+    if not thread_ids:
+        return {}
+    exclude_ids = list(exclude_ids)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT thread_id, sender, summary FROM emails
+        WHERE thread_id IN ({','.join('?' * len(thread_ids))}) AND id NOT IN ({','.join('?' * len(exclude_ids))})
+            AND is_processed = 1 AND summary IS NOT NULL AND summary != ''
+        ORDER BY timestamp ASC
+    ''', thread_ids + exclude_ids)
+    rows = cursor.fetchall()
+    conn.close()
+    summaries = {}
     for row in rows:
-        email = dict(row)
-        if email['action_items']:
-            try:
-                email['action_items'] = json.loads(email['action_items'])
-            except Exception:
-                email['action_items'] = []
-        emails.append(email)
-    return emails
+        summaries.setdefault(row['thread_id'], []).append({"sender": row['sender'], "summary": row['summary']})
+    return summaries
+
+def get_clusters(email_ids: List[str]) -> Dict[str, str]:
+    """Map each email ID to its near-duplicate cluster ID (the representative's email ID)."""
+    if not email_ids:
+        return {}
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(email_ids))
+    cursor.execute(f'SELECT email_id, cluster_id FROM email_signatures WHERE email_id IN ({placeholders})', list(email_ids))
+    rows = cursor.fetchall()
+    conn.close()
+    return {row['email_id']: row['cluster_id'] for row in rows}
+
+def get_processed_email_ids(email_ids: List[str]) -> List[str]:
+    """Return which of the given emails have already been processed."""
+    if not email_ids:
+        return []
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    placeholders = ','.join('?' * len(email_ids))
+    cursor.execute(f'SELECT id FROM emails WHERE is_processed = 1 AND id IN ({placeholders})', list(email_ids))
+    rows = cursor.fetchall()
+    conn.close()
+    return [row['id'] for row in rows]
+
+def copy_email_result(source_id: str, target_ids: List[str]) -> int:
+    """
+    Reuse the category of one email for its near-duplicates, and its summary for those
+    with the same template key (same sender and numbers). Action items and drafts depend
+    on the exact content, so they are left empty (drafts pending).
+    Returns how many emails were updated (none if the source has no results yet).
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('''
+        UPDATE emails
+        SET (category, summary, categorization_version, action_items, generated_draft, is_processed,
+             extraction_version, auto_reply_version) =
+            (SELECT category,
+                    CASE WHEN (SELECT template_key FROM email_signatures WHERE email_id = source.id) =
+                              (SELECT template_key FROM email_signatures WHERE email_id = emails.id)
+                         THEN summary END,
+                    categorization_version, NULL, NULL, 1, NULL, NULL
+             FROM emails AS source WHERE source.id = ?)
+        WHERE id = ? AND EXISTS (SELECT 1 FROM emails WHERE id = ? AND is_processed = 1)
+    ''', [(source_id, target_id, source_id) for target_id in target_ids])
+    copied = cursor.rowcount
+    bump_change_counter(cursor, EMAILS_SCOPE)
+    conn.commit()
+    conn.close()
+    return copied
+
+def get_dedup_stats() -> Dict[str, float]:
+    """Report how many stored emails are near-duplicates of another email."""
+    return cached_query(EMAILS_SCOPE, "dedup_stats", _load_dedup_stats)
+
+def _load_dedup_stats() -> Dict[str, float]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COUNT(*) AS emails, COUNT(DISTINCT cluster_id) AS clusters FROM email_signatures')
+    row = cursor.fetchone()
+    conn.close()
+    emails, clusters = row['emails'], row['clusters']
+    duplicates = emails - clusters
+    return {
+        "emails": emails,
+        "clusters": clusters,
+        "duplicates": duplicates,
+        "dedup_ratio": duplicates / emails if emails else 0.0
+    }
 
 def clear_all_emails():
     """Delete all emails from the database."""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('DELETE FROM emails')
+    cursor.execute('DELETE FROM threads')
+    cursor.execute('DELETE FROM email_signatures')
+    cursor.execute('DELETE FROM signature_bands')
+    cursor.execute('DELETE FROM digests')
+    bump_change_counter(cursor, EMAILS_SCOPE)
+    bump_change_counter(cursor, DIGESTS_SCOPE)
     conn.commit()
     conn.close()
 
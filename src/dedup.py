@@ -0,0 +1,127 @@
+import hashlib
+import re
+from typing import Optional
+
+# 64-bit SimHash over word pairs, split into 8 bands of 8 bits for the lookup: two
+# signatures within 7 bits of each other always share a band (pigeonhole), and ones
+# up to MAX_HAMMING_DISTANCE apart usually do, so candidates come from an index
+# instead of a scan of every signature.
+SIMHASH_BITS = 64
+NUM_BANDS = 8
+BAND_BITS = SIMHASH_BITS // NUM_BANDS
+SHINGLE_SIZE = 2
+# Measured on templated mail of ~60 words: a changed name moves 5-15 bits, unrelated
+# text from the same sender 25+; shorter texts are noisier and get a tighter bound
+MAX_HAMMING_DISTANCE = 12
+SHORT_TEXT_SHINGLES = 40
+SHORT_TEXT_MAX_DISTANCE = 8
+
+# Below this many shingles a signature is too noisy to cluster on
+MIN_SHINGLES = 8
+
+# Bumped whenever signatures are computed differently; init_db then rebuilds the index
+SIGNATURE_VERSION = 3
+
+URL_RE = re.compile(r'https?://\S+')
+DIGIT_RE = re.compile(r'\d+')
+TOKEN_RE = re.compile(r'\w+')
+EMAIL_ADDRESS_RE = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+def _tokens(text: str):
+    """Normalizes the variable fields of templated mail (links, numbers) before tokenizing."""
+    text = URL_RE.sub(' url ', text.lower())
+    text = DIGIT_RE.sub('0', text)
+    return TOKEN_RE.findall(text)
+
+def _shingles(text: str):
+    tokens = _tokens(text or "")
+    return [' '.join(tokens[i:i + SHINGLE_SIZE]) for i in range(max(len(tokens) - SHINGLE_SIZE + 1, 0))]
+
+def max_distance(shingle_count: int) -> int:
+    return SHORT_TEXT_MAX_DISTANCE if shingle_count < SHORT_TEXT_SHINGLES else MAX_HAMMING_DISTANCE
+
+def template_key(email) -> str:
+    """
+    Hash of the sender address and every number in the email (amounts, dates, order numbers).
+    Clustering ignores numbers; a summary is only reused between emails with the same key.
+    """
+    sender = email.get('sender') or ''
+    match = EMAIL_ADDRESS_RE.search(sender)
+    sender = (match.group(0) if match else sender).lower()
+    text = URL_RE.sub(' ', f"{email.get('subject') or ''}\n{email.get('body') or ''}")
+    numbers = ' '.join(DIGIT_RE.findall(text))
+    return hashlib.blake2b(f"{sender}\n{numbers}".encode('utf-8'), digest_size=8).hexdigest()
+
+def compute_simhash(text: str) -> Optional[int]:
+    """Computes a 64-bit SimHash over word shingles, or None if the text is too short."""
+    shingles = _shingles(text)
+    if len(shingles) < MIN_SHINGLES:
+        return None
+
+    weights = [0] * SIMHASH_BITS
+    for shingle in shingles:
+        h = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(SIMHASH_BITS):
+            weights[bit] += 1 if h >> bit & 1 else -1
+
+    return sum(1 << bit for bit in range(SIMHASH_BITS) if weights[bit] > 0)
+
+def band_values(simhash: int):
+    """Splits a signature into its bands, as (band index, value) pairs."""
+    mask = (1 << BAND_BITS) - 1
+    return [(band, simhash >> (band * BAND_BITS) & mask) for band in range(NUM_BANDS)]
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+def _to_sqlite(simhash: int) -> int:
+    # SQLite integers are signed 64-bit
+    return simhash - (1 << 64) if simhash >= 1 << 63 else simhash
+
+def _from_sqlite(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+def signature_text(email) -> str:
+    """Text a signature is computed from; the sender keeps different templates apart."""
+    return f"{email.get('sender') or ''}\n{email.get('subject') or ''}\n{email.get('body') or ''}"
+
+def index_email(cursor, email) -> str:
+    """
+    Stores the email's signature and assigns it to a near-duplicate cluster.
+    Returns the cluster ID, which is the ID of the cluster's first email (its representative).
+    """
+    email_id = email['id']
+    text = signature_text(email)
+    key = template_key(email)
+    simhash = compute_simhash(text)
+    if simhash is None:
+        cursor.execute('''
+            INSERT OR REPLACE INTO email_signatures (email_id, simhash, cluster_id, template_key) VALUES (?, NULL, ?, ?)
+        ''', (email_id, email_id, key))
+        cursor.execute('DELETE FROM signature_bands WHERE email_id = ?', (email_id,))
+        return email_id
+
+    bands = band_values(simhash)
+    conditions = ' OR '.join(['(b.band = ? AND b.value = ?)'] * len(bands))
+    params = [value for pair in bands for value in pair]
+    cursor.execute(f'''
+        SELECT DISTINCT s.email_id, s.simhash, s.cluster_id
+        FROM signature_bands b JOIN email_signatures s ON s.email_id = b.email_id
+        WHERE ({conditions}) AND s.email_id != ?
+    ''', params + [email_id])
+
+    cluster_id = email_id
+    best_distance = max_distance(len(_shingles(text))) + 1
+    for row in cursor.fetchall():
+        distance = hamming_distance(simhash, _from_sqlite(row['simhash']))
+        if distance < best_distance:
+            best_distance = distance
+            cluster_id = row['cluster_id']
+
+    cursor.execute('''
+        INSERT OR REPLACE INTO email_signatures (email_id, simhash, cluster_id, template_key) VALUES (?, ?, ?, ?)
+    ''', (email_id, _to_sqlite(simhash), cluster_id, key))
+    cursor.execute('DELETE FROM signature_bands WHERE email_id = ?', (email_id,))
+    cursor.executemany('INSERT INTO signature_bands (band, value, email_id) VALUES (?, ?, ?)',
+                       [(band, value, email_id) for band, value in bands])
+    return cluster_id
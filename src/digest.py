@@ -0,0 +1,326 @@
+import hashlib
+import json
+import threading
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Callable
+from .db_utils import get_db_connection, bump_change_counter, cached_query, get_change_counter, EMAILS_SCOPE, DIGESTS_SCOPE
+from .rate_limit import call_with_retry, estimate_tokens
+
+# Buckets with at most this many emails are digested without a model call
+SMALL_BUCKET = 3
+# Summaries per model call when digesting a large bucket (map step); partial digests are reduced again
+MAP_CHUNK = 40
+# Days (counting back from the newest email) kept at day/category granularity in the chat context;
+# older mail is represented by one digest per month
+DETAIL_DAYS = 14
+# Upper bound on the digest context handed to the chat, whatever the inbox size
+MAX_CONTEXT_CHARS = 12000
+
+# One refresh at a time per process
+_refresh_lock = threading.Lock()
+# At most one background refresh thread per process (see start_digest_refresh)
+_background_lock = threading.Lock()
+_background_thread = None
+_background_requested = False
+
+# meta key holding the emails change counter the stored digests were built from
+BUILT_FROM_KEY = "digest_built_from"
+
+DIGEST_PROMPT = """You are condensing an email inbox into a digest.
+Below are summaries and action items of {count} emails ({scope}).
+Write a concise 2-4 sentence digest of what happened, and list the consolidated action items,
+keeping any deadlines, dates, amounts and who asked for what. Drop duplicates.
+
+RETURN ONLY JSON: {{"summary": "...", "action_items": ["...", "..."]}}
+
+{entries}
+"""
+
+def _fingerprint(parts: List[str]) -> str:
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+def _load_buckets() -> Dict[tuple, List[Dict]]:
+    """Groups processed emails into (day, category) buckets."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, sender, subject, summary, action_items, substr(timestamp, 1, 10) AS day, category
+        FROM emails WHERE is_processed = 1
+        ORDER BY id
+    ''')
+    buckets = {}
+    for row in cursor.fetchall():
+        key = (row['day'] or 'unknown', row['category'] or 'Uncategorized')
+        buckets.setdefault(key, []).append(dict(row))
+    conn.close()
+    return buckets
+
+def _stored_fingerprints(level: str) -> Dict[tuple, str]:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT period, category, fingerprint FROM digests WHERE level = ?', (level,))
+    fingerprints = {(row['period'], row['category']): row['fingerprint'] for row in cursor.fetchall()}
+    conn.close()
+    return fingerprints
+
+def _save_digest(level: str, period: str, category: str, digest: Dict, email_count: int, fingerprint: str):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO digests (level, period, category, summary, action_items, email_count, fingerprint, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (level, period, category, digest['summary'], json.dumps(digest['action_items']), email_count, fingerprint,
+          datetime.now(timezone.utc).isoformat()))
+    bump_change_counter(cursor, DIGESTS_SCOPE)
+    conn.commit()
+    conn.close()
+
+def _delete_digests(level: str, keys: List[tuple]):
+    if not keys:
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany('DELETE FROM digests WHERE level = ? AND period = ? AND category = ?',
+                       [(level, period, category) for period, category in keys])
+    bump_change_counter(cursor, DIGESTS_SCOPE)
+    conn.commit()
+    conn.close()
+
+def _entry_text(entry: Dict) -> str:
+    action_items = entry.get('action_items') or []
+    if isinstance(action_items, str):
+        try:
+            action_items = json.loads(action_items)
+        except Exception:
+            action_items = [action_items]
+    text = f"- {entry.get('label') or ''}{entry.get('summary') or ''}"
+    if action_items:
+        text += f" | Action items: {'; '.join(map(str, action_items))}"
+    return text
+
+def _concat_digest(entries: List[Dict]) -> Dict:
+    """Digest of a small bucket: the summaries themselves, no model call needed."""
+    action_items = []
+    for entry in entries:
+        items = entry.get('action_items') or []
+        if isinstance(items, str):
+            try:
+                items = json.loads(items)
+            except Exception:
+                items = [items]
+        action_items.extend(str(item) for item in items)
+    return {
+        "summary": "; ".join(f"{e.get('label') or ''}{e.get('summary') or ''}".strip() for e in entries),
+        "action_items": action_items
+    }
+
+def _llm_digest(entries: List[Dict], scope: str) -> Dict:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from langchain_core.output_parsers import JsonOutputParser
+
+    prompt = DIGEST_PROMPT.format(count=len(entries), scope=scope, entries="\n".join(_entry_text(e) for e in entries))
+    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite", temperature=0, max_retries=0)
+    response = call_with_retry(lambda: llm.invoke(prompt), estimated_tokens=estimate_tokens(prompt))
+    content = response.content
+    if "```" in content:
+        content = content.split("```json")[-1] if "```json" in content else content.split("```")[1]
+        content = content.split("```")[0]
+    parsed = JsonOutputParser().parse(content.strip())
+    return {
+        "summary": str(parsed.get("summary") or ""),
+        "action_items": [str(item) for item in parsed.get("action_items") or []]
+    }
+
+def summarize_entries(entries: List[Dict], scope: str) -> Dict:
+    """Map-reduce over entries ({summary, action_items, label}) into one digest."""
+    if len(entries) <= SMALL_BUCKET:
+        return _concat_digest(entries)
+    if len(entries) <= MAP_CHUNK:
+        return _llm_digest(entries, scope)
+    partials = [
+        summarize_entries(entries[i:i + MAP_CHUNK], scope)
+        for i in range(0, len(entries), MAP_CHUNK)
+    ]
+    return summarize_entries(partials, scope)
+
+def _detail_cutoff(days: List[str]) -> Optional[str]:
+    """First day shown at day/category granularity: DETAIL_DAYS back from the newest day, at a month boundary."""
+    dated = [day for day in days if day != 'unknown']
+    if not dated:
+        return None
+    try:
+        newest_date = datetime.fromisoformat(max(dated)).date()
+    except ValueError:
+        return None
+    cutoff = newest_date.fromordinal(newest_date.toordinal() - DETAIL_DAYS + 1).isoformat()
+    # Start detail at a month boundary so no day falls between the two levels
+    return cutoff[:7] + "-01"
+
+def _built_from() -> Optional[int]:
+    conn = get_db_connection()
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (BUILT_FROM_KEY,)).fetchone()
+    conn.close()
+    return row['value'] if row else None
+
+def _set_built_from(version: int):
+    conn = get_db_connection()
+    conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (BUILT_FROM_KEY, version))
+    conn.commit()
+    conn.close()
+
+def refresh_digests(on_progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, int]:
+    """
+    Brings the digest tables up to date. Only (day, category) buckets whose emails or
+    results changed since their digest was built are re-summarized, and only months
+    containing such buckets are rolled up again. Returns {buckets, refreshed, months_refreshed}.
+    Callers at the same time wait for the running refresh instead of repeating its model
+    calls, and find nothing left to do while the emails have not changed.
+    """
+    with _refresh_lock:
+        version = get_change_counter(EMAILS_SCOPE)
+        if _built_from() == version:
+            return {"buckets": len(_stored_fingerprints('day')), "refreshed": 0, "months_refreshed": 0}
+        stats = _refresh_digests(on_progress)
+        # Emails changed during the refresh leave the digest stale for the next one
+        _set_built_from(version)
+        return stats
+
+def is_digest_stale() -> bool:
+    """Whether emails were added or (re)processed since the stored digests were built."""
+    return _built_from() != get_change_counter(EMAILS_SCOPE)
+
+def is_digest_refreshing() -> bool:
+    return _background_thread is not None
+
+def start_digest_refresh() -> threading.Thread:
+    """
+    Runs refresh_digests in a daemon thread so the caller (a processing run, the chat)
+    does not wait for its model calls. While a refresh is running, no second one starts;
+    the running thread makes one more pass when it is done and is returned instead.
+    """
+    global _background_thread, _background_requested
+
+    def run():
+        global _background_thread, _background_requested
+        while True:
+            try:
+                stats = refresh_digests()
+                print(f"Refreshed {stats['refreshed']} of {stats['buckets']} day digests")
+            except Exception as e:
+                # The chat keeps answering from the digests stored so far
+                print(f"Digest refresh error: {e}")
+            with _background_lock:
+                if not _background_requested:
+                    _background_thread = None
+                    return
+                _background_requested = False
+
+    with _background_lock:
+        if _background_thread is not None:
+            _background_requested = True
+            return _background_thread
+        _background_thread = threading.Thread(target=run, daemon=True, name="digest-refresh")
+        _background_thread.start()
+        return _background_thread
+
+def _refresh_digests(on_progress: Optional[Callable[[int, int], None]]) -> Dict[str, int]:
+    buckets = _load_buckets()
+    stored = _stored_fingerprints('day')
+
+    fingerprints = {
+        key: _fingerprint([f"{e['id']}|{e['summary']}|{e['action_items']}" for e in emails])
+        for key, emails in buckets.items()
+    }
+    stale = [key for key, fp in fingerprints.items() if stored.get(key) != fp]
+    _delete_digests('day', [key for key in stored if key not in buckets])
+
+    for n, key in enumerate(sorted(stale), 1):
+        day, category = key
+        entries = [
+            {"summary": e['summary'], "action_items": e['action_items'], "label": f"{e['sender']} - {e['subject']}: "}
+            for e in buckets[key]
+        ]
+        digest = summarize_entries(entries, f"{category} emails on {day}")
+        _save_digest('day', day, category, digest, len(buckets[key]), fingerprints[key])
+        if on_progress:
+            on_progress(n, len(stale))
+
+    # Month level: rolls up the day/category digests of each month older than the detail window
+    cutoff = _detail_cutoff([day for day, _ in buckets])
+    months = {}
+    for day, category in buckets:
+        if cutoff and day < cutoff:
+            months.setdefault(day[:7], []).append((day, category))
+    stored_months = _stored_fingerprints('month')
+    _delete_digests('month', [key for key in stored_months if key[0] not in months])
+
+    day_digests = get_digests('day')
+    months_refreshed = 0
+    for month, keys in months.items():
+        fp = _fingerprint(sorted(fingerprints[key] for key in keys))
+        if stored_months.get((month, '*')) == fp:
+            continue
+        entries = [
+            {"summary": d['summary'], "action_items": d['action_items'], "label": f"{d['period']} {d['category']}: "}
+            for d in day_digests if d['period'][:7] == month
+        ]
+        digest = summarize_entries(entries, f"the month {month}")
+        _save_digest('month', month, '*', digest, sum(len(buckets[key]) for key in keys), fp)
+        months_refreshed += 1
+
+    return {"buckets": len(buckets), "refreshed": len(stale), "months_refreshed": months_refreshed}
+
+def get_digests(level: str = 'day') -> List[Dict]:
+    """Fetch stored digests of one level, newest period first."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM digests WHERE level = ? ORDER BY period DESC, category ASC', (level,))
+    rows = cursor.fetchall()
+    conn.close()
+    digests = []
+    for row in rows:
+        digest = dict(row)
+        try:
+            digest['action_items'] = json.loads(digest['action_items']) if digest['action_items'] else []
+        except Exception:
+            digest['action_items'] = []
+        digests.append(digest)
+    return digests
+
+def get_digest_context(max_chars: int = MAX_CONTEXT_CHARS) -> str:
+    """
+    Compact whole-inbox context for the chat: day/category digests for the most recent
+    DETAIL_DAYS days, month digests for everything older, capped at max_chars.
+    """
+    return cached_query(DIGESTS_SCOPE, ("digest_context", max_chars), lambda: _build_digest_context(max_chars))
+
+def _build_digest_context(max_chars: int) -> str:
+    day_digests = get_digests('day')
+    if not day_digests:
+        return ""
+
+    cutoff = _detail_cutoff([d['period'] for d in day_digests])
+
+    lines = ["Inbox digest (recent days by category, older mail by month):"]
+    for d in day_digests:
+        if cutoff and d['period'] < cutoff:
+            continue
+        line = f"- {d['period']} | {d['category']} | {d['email_count']} emails: {d['summary']}"
+        if d['action_items']:
+            line += f" Action items: {'; '.join(d['action_items'])}"
+        lines.append(line)
+
+    if cutoff:
+        for d in get_digests('month'):
+            line = f"- {d['period']} (month) | {d['email_count']} emails: {d['summary']}"
+            if d['action_items']:
+                line += f" Action items: {'; '.join(d['action_items'])}"
+            lines.append(line)
+
+    context = ""
+    for line in lines:
+        if len(context) + len(line) + 1 > max_chars:
+            context += "- (older digests omitted)\n"
+            break
+        context += line + "\n"
+    return context
@@ -1,24 +1,162 @@
-from typing import TypedDict, List, Dict, Any
-from langgraph.graph import StateGraph, END
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+from typing import TypedDict, List, Dict, Any, Annotated
+import functools
 import json
+import operator
+import os
+import threading
+from src.db_utils import save_batch_results
+from src.rate_limit import call_with_retry, estimate_tokens
+
+# Reserved key in the results map holding updated rolling summaries (thread_id -> summary)
+THREAD_SUMMARIES_KEY = "_threads"
+
+# Every field a full run produces, in prompt order
+RESULT_FIELDS = ["category", "action_items", "generated_draft", "summary"]
+
+def merge_results(left: Dict[str, Any], right: Dict[str, Any]) -> Dict[str, Any]:
+    """Fan-in reducer: merges per-batch result maps, including their thread summaries."""
+    merged = dict(left or {})
+    for key, value in (right or {}).items():
+        if key == THREAD_SUMMARIES_KEY:
+            merged[key] = {**merged.get(key, {}), **(value or {})}
+        else:
+            merged[key] = value
+    return merged
 
 # --- 1. Define Batch State ---
-class BatchState(TypedDict):
-    emails: List[Dict[str, Any]]  # List of {id, content, sender}
-    results: Dict[str, Dict[str, Any]] # Map id -> {category, action_items, generated_draft}
+class BatchState(TypedDict, total=False):
+    emails: List[Dict[str, Any]]  # List of {id, content, sender, thread_id}
+    results: Annotated[Dict[str, Dict[str, Any]], merge_results] # Map id -> {category, action_items, generated_draft}
     user_prompts: Dict[str, str]
+    threads: Dict[str, str] # Map thread_id -> rolling summary so far, for multi-message threads
+    fields: List[str] # Result fields to produce; defaults to RESULT_FIELDS
+    partial: bool # Whether fields of already processed emails are being updated (vs. first processing)
+    batch_size: int # Emails per model call
+    batches: List[List[Dict[str, Any]]] # Sub-batches planned by the planner node
+    persist: bool # Whether each batch writes its results to the database as soon as it finishes
+    prompt_versions: Dict[str, int] # Prompt versions recorded with persisted results
+    completed: Annotated[List[str], operator.add] # IDs of emails whose batch has finished
+    errors: Annotated[List[str], operator.add] # One entry per failed batch
+    failed: Annotated[List[str], operator.add] # IDs of emails whose batch failed; left unprocessed
+    persisted: Annotated[int, operator.add] # Emails whose results were saved, summed over batches
+
+# --- Concurrency limiter ---
+# Bounds in-flight model calls across every graph run in this process
+DEFAULT_MAX_CONCURRENCY = int(os.environ.get("EMAIL_AGENT_MAX_CONCURRENCY", "4"))
+
+class CallSlots:
+    """
+    Counting limiter whose size can change while calls are in flight: calls already
+    running keep their slot, new calls wait until fewer than the new limit are running.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def resize(self, limit: int):
+        with self._condition:
+            self.limit = limit
+            self._condition.notify_all()
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.in_use < self.limit)
+            self.in_use += 1
+
+    def __exit__(self, *exc_info):
+        with self._condition:
+            self.in_use -= 1
+            self._condition.notify()
+
+_model_call_slots = CallSlots(DEFAULT_MAX_CONCURRENCY)
+
+def set_max_concurrency(max_concurrency: int):
+    """Changes how many model calls may be in flight at once, for every run in this process."""
+    _model_call_slots.resize(max(1, max_concurrency))
+
+# --- 2. Compact Response Protocol ---
+# The model answers with short keys, category codes and batch-local email numbers
+# instead of repeating full IDs and verbose keys for every email, which keeps
+# output tokens (the slowest and most expensive part of a call) to a minimum.
+
+COMPACT_KEYS = {"category": "c", "action_items": "a", "generated_draft": "d", "summary": "s"}
+CATEGORY_CODES = {"W": "Work", "P": "Personal", "S": "Spam", "N": "Newsletter"}
+NO_DRAFT = "N/A"
+
+def parse_compact_response(content: str, batch_ids: List[str], fields: List[str],
+                           thread_ids: Dict[int, str] = None) -> Dict[str, Any]:
+    """
+    Validates a compact response and expands it to the results format used by the
+    rest of the pipeline (full email IDs, long keys, category names).
+    Raises ValueError if the payload is not a compact response at all; malformed
+    entries are dropped so those emails stay unprocessed.
+    """
+    payload = json.loads(content)
+    if not isinstance(payload, dict) or not isinstance(payload.get("r"), list):
+        raise ValueError("Compact response must be an object with an 'r' list")
+
+    results = {}
+    for entry in payload["r"]:
+        index = entry.get("i") if isinstance(entry, dict) else None
+        if isinstance(index, str) and index.isdigit():
+            index = int(index)
+        if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < len(batch_ids):
+            print(f"Dropping compact entry with invalid index: {entry!r}")
+            continue
+        email_id = batch_ids[index]
+        if email_id in results:
+            continue
+
+        res = {}
+        if "category" in fields:
+            code = entry.get("c")
+            if not isinstance(code, str) or not code.strip():
+                print(f"Dropping compact entry without category: {entry!r}")
+                continue
+            code = code.strip()
+            res["category"] = CATEGORY_CODES.get(code.upper(), code) if len(code) == 1 else code
+        if "action_items" in fields:
+            items = entry.get("a", [])
+            if isinstance(items, str):
+                items = [items]
+            if not isinstance(items, list):
+                print(f"Dropping compact entry with invalid action items: {entry!r}")
+                continue
+            res["action_items"] = [str(item) for item in items]
+        if "generated_draft" in fields:
+            draft = entry.get("d")
+            res["generated_draft"] = draft if isinstance(draft, str) and draft.strip() else NO_DRAFT
+        if "summary" in fields:
+            res["summary"] = str(entry.get("s") or "")
+        results[email_id] = res
+
+    thread_summaries = payload.get("t")
+    if thread_ids and isinstance(thread_summaries, dict):
+        expanded = {}
+        for number, summary in thread_summaries.items():
+            try:
+                thread_id = thread_ids.get(int(number))
+            except (TypeError, ValueError):
+                thread_id = None
+            if thread_id and isinstance(summary, str) and summary:
+                expanded[thread_id] = summary
+        results[THREAD_SUMMARIES_KEY] = expanded
 
-# --- 2. Define Batch Node ---
+    return results
 
-import base64
-import requests
-from langchain_core.messages import HumanMessage
+# --- 3. Define Batch Node ---
+# LangGraph/LangChain are imported inside the functions that need them, so importing
+# this module (e.g. for its constants) stays cheap until a graph actually runs.
 
 def batch_processor_node(state: BatchState):
     """Processes a batch of emails in a single LLM call, supporting images."""
+    import base64
+    import requests
+    from langchain_core.messages import HumanMessage
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
     print(f"--- Processing Batch of {len(state['emails'])} Emails ---")
     
     # Get user custom instructions
@@ -26,26 +164,55 @@ def batch_processor_node(state: BatchState):
     ext_prompt = state['user_prompts'].get('extraction', "Extract key action items.")
     draft_prompt = state['user_prompts'].get('auto_reply', "Draft a professional reply if not spam.")
     
+    # Only ask for the requested fields (e.g. category-only when just the categorization prompt changed)
+    fields = [f for f in RESULT_FIELDS if f in (state.get('fields') or RESULT_FIELDS)]
+    category_codes = ", ".join(f"{code}={name}" for code, name in CATEGORY_CODES.items())
+    field_instructions = {
+        "category": f"\"c\" (Category): {cat_prompt} Answer with the code {category_codes}; only if the instructions call for another category, give its full name.",
+        "action_items": f"\"a\" (Action Items): {ext_prompt} (A list of strings; omit the key if there are none)",
+        "generated_draft": f"\"d\" (Draft Reply): {draft_prompt} (Omit the key if Spam or no reply needed)",
+        "summary": "\"s\" (Summary): A concise 1-2 sentence summary of the email content."
+    }
+    numbered_instructions = "\n    ".join(f"{n}. {field_instructions[f]}" for n, f in enumerate(fields, 1))
+    
     system_instruction = f"""
     You are an intelligent email assistant. Process the following batch of emails.
     Some emails may contain attached images. Use the image context to improve categorization and extraction (e.g., if it's a receipt or a screenshot of an error).
     
     For EACH email, you must provide:
-    1. Category: {cat_prompt}
-    2. Action Items: {ext_prompt} (Return as a list of strings)
-    3. Draft Reply: {draft_prompt} (Return 'N/A' if Spam or no reply needed)
-    4. Summary: A concise 1-2 sentence summary of the email content.
+    {numbered_instructions}
     
-    RETURN ONLY JSON. The output must be a JSON object where keys are the Email IDs and values are objects containing 'category', 'action_items', 'generated_draft', and 'summary'.
+    RETURN ONLY JSON, in this compact form: {{"r": [{{"i": <email number>, {", ".join(f'"{COMPACT_KEYS[f]}": ...' for f in fields)}}}, ...]}}
+    with exactly one entry per email, where "i" is the number shown as "Email #<number>".
+    """
+
+    threads = state.get('threads') or {}
+    # Threads are referred to by batch-local numbers too
+    thread_numbers = {}
+    for email in state['emails']:
+        if email.get('thread_id') in threads and email['thread_id'] not in thread_numbers:
+            thread_numbers[email['thread_id']] = len(thread_numbers)
+    if threads:
+        system_instruction += """
+    Some emails are the newest messages of an ongoing conversation thread. For those, only the new message is included, together with a summary of the thread so far. Use the thread summary as context.
+    Additionally include the key "t" in the JSON object, mapping each thread number (as a string) to an updated 2-3 sentence summary of the whole thread including the new messages.
     """
     
     # Construct Multimodal Message
     content_parts = []
     content_parts.append({"type": "text", "text": system_instruction})
     
-    for email in state['emails']:
+    current_thread = None
+    for index, email in enumerate(state['emails']):
+        # Introduce each thread once, before its new messages
+        thread_id = email.get('thread_id')
+        if thread_id in threads and thread_id != current_thread:
+            thread_text = f"\n===\nThread #{thread_numbers[thread_id]}\nThread summary so far: {threads[thread_id] or 'N/A (first summary of this thread)'}\n"
+            content_parts.append({"type": "text", "text": thread_text})
+        current_thread = thread_id
+
         # Add Text Content
-        email_text = f"\n---\nEmail ID: {email['id']}\nFrom: {email['sender']}\nBody:\n{email['content']}\n"
+        email_text = f"\n---\nEmail #{index}\nFrom: {email['sender']}\nBody:\n{email['content']}\n"
         content_parts.append({"type": "text", "text": email_text})
         
         # Add Image Content if available
@@ -65,42 +232,165 @@ def batch_processor_node(state: BatchState):
                 print(f"Failed to load image for {email['id']}: {e}")
     
     # Call LLM
-    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite", temperature=0)
+    # JSON mode makes the model emit bare JSON; retries are handled by the shared rate limiter / retry scheduler
+    llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite", temperature=0, max_retries=0,
+                                 response_mime_type="application/json")
+    batch_ids = [email['id'] for email in state['emails']]
     
     # We use a direct HumanMessage invocation for multimodal
     message = HumanMessage(content=content_parts)
     
-    # Use JsonOutputParser to parse the text result
-    parser = JsonOutputParser()
-    
     try:
         # Invoke with the message list
-        response_msg = llm.invoke([message])
+        with _model_call_slots:
+            response_msg = call_with_retry(lambda: llm.invoke([message]), estimated_tokens=estimate_tokens(content_parts))
         content = response_msg.content
         
-        # Strip markdown code blocks if present
+        # Strip markdown code blocks if present (models without JSON mode)
         if "```json" in content:
             content = content.split("```json")[1].split("```")[0].strip()
         elif "```" in content:
             content = content.split("```")[1].split("```")[0].strip()
+        print(f"--- Batch output: {len(content)} chars for {len(batch_ids)} emails ---")
             
-        # Parse the content of the response
-        parsed_result = parser.parse(content)
-        return {"results": parsed_result}
+        # Parse and validate the compact response, mapping numbers back to IDs
+        thread_ids = {number: thread_id for thread_id, number in thread_numbers.items()}
+        parsed_result = parse_compact_response(content, batch_ids, fields, thread_ids)
+        persisted = 0
+        if state.get('persist'):
+            # Saved now, so a run that ends early keeps every batch already paid for
+            persisted = persist_results(validate_results(parsed_result, batch_ids, fields), batch_ids, state)
+        return {"results": parsed_result, "completed": batch_ids, "persisted": persisted}
     except Exception as e:
         print(f"Batch Processing Error: {e}")
-        return {"results": {}}
+        return {"results": {}, "completed": batch_ids, "errors": [str(e)], "failed": batch_ids}
+
+# --- 4. Fan-out / Fan-in Nodes ---
+
+def plan_batches(emails: List[Dict[str, Any]], batch_size: int) -> List[List[Dict[str, Any]]]:
+    """Splits emails into sub-batches, keeping the messages of a thread in the same batch."""
+    groups = []
+    for email in emails:
+        thread_id = email.get('thread_id') or email['id']
+        if groups and groups[-1][0] == thread_id:
+            groups[-1][1].append(email)
+        else:
+            groups.append((thread_id, [email]))
 
-# --- 3. Build Graph ---
+    batches = []
+    current = []
+    for _, group in groups:
+        if current and len(current) + len(group) > batch_size:
+            batches.append(current)
+            current = []
+        current.extend(group)
+    if current:
+        batches.append(current)
+    return batches
+
+def planner_node(state: BatchState):
+    """Splits the incoming email list into sub-batches for parallel processing."""
+    batches = plan_batches(state.get('emails', []), state.get('batch_size') or 10)
+    print(f"--- Planned {len(batches)} Batches for {len(state.get('emails', []))} Emails ---")
+    return {"batches": batches}
+
+def dispatch_batches(state: BatchState):
+    """Fans out one batch_processor task per planned sub-batch."""
+    from langgraph.types import Send
+
+    batches = state.get('batches') or []
+    if not batches:
+        return "reducer"
+    threads = state.get('threads') or {}
+    sends = []
+    for batch in batches:
+        batch_threads = {email.get('thread_id') for email in batch}
+        sends.append(Send("batch_processor", {
+            "emails": batch,
+            "user_prompts": state['user_prompts'],
+            "threads": {tid: summary for tid, summary in threads.items() if tid in batch_threads},
+            "fields": state.get('fields') or RESULT_FIELDS,
+            "partial": state.get('partial', False),
+            "persist": state.get('persist', False),
+            "prompt_versions": state.get('prompt_versions') or {}
+        }))
+    return sends
+
+def _clean_result(res: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """Coerces one model result to the types stored in the emails table."""
+    clean = {}
+    if "category" in fields and "category" in res:
+        clean["category"] = str(res["category"] or "Uncategorized").strip()
+    if "action_items" in fields and "action_items" in res:
+        items = res["action_items"] or []
+        if isinstance(items, str):
+            items = [items]
+        clean["action_items"] = [str(item).strip() for item in items if str(item).strip()]
+    if "generated_draft" in fields and "generated_draft" in res:
+        clean["generated_draft"] = str(res["generated_draft"] or "")
+    if "summary" in fields and "summary" in res:
+        clean["summary"] = str(res["summary"] or "")
+    return clean
+
+def validate_results(results: Dict[str, Any], email_ids: List[str], fields: List[str]) -> Dict[str, Any]:
+    """Keeps only results for emails in the run, with well-typed fields, plus thread summaries."""
+    validated = {}
+    for email_id in email_ids:
+        res = results.get(email_id)
+        if isinstance(res, dict):
+            validated[email_id] = _clean_result(res, fields)
+    thread_summaries = results.get(THREAD_SUMMARIES_KEY)
+    if isinstance(thread_summaries, dict):
+        validated[THREAD_SUMMARIES_KEY] = {str(k): str(v) for k, v in thread_summaries.items() if v}
+    return validated
+
+def persist_results(validated: Dict[str, Any], email_ids: List[str], state: BatchState) -> int:
+    """Saves one batch's validated results and thread summaries in a single transaction."""
+    fields = state.get('fields') or RESULT_FIELDS
+    partial = state.get('partial', set(fields) != set(RESULT_FIELDS))
+    # Emails the model skipped (or answered invalidly) are left as they were
+    results = {email_id: validated[email_id] for email_id in email_ids if validated.get(email_id)}
+    threads = state.get('threads') or {}
+    thread_summaries = {
+        thread_id: thread_summary
+        for thread_id, thread_summary in validated.get(THREAD_SUMMARIES_KEY, {}).items()
+        if thread_id in threads
+    }
+    return save_batch_results(results, state.get('prompt_versions'), partial, thread_summaries)
+
+def reducer_node(state: BatchState):
+    """Merges and validates the results of all sub-batches (each batch has saved its own)."""
+    fields = state.get('fields') or RESULT_FIELDS
+    # Emails of failed batches stay unprocessed so the next run retries them
+    failed = set(state.get('failed') or [])
+    email_ids = [email['id'] for email in state.get('emails', []) if email['id'] not in failed]
+    return {"results": validate_results(state.get('results') or {}, email_ids, fields)}
+
+# --- 5. Build Graph ---
 
 def build_batch_graph():
+    """planner -> N x batch_processor (in parallel, via Send) -> reducer -> END"""
+    from langgraph.graph import StateGraph, END
+
     workflow = StateGraph(BatchState)
     
+    workflow.add_node("planner", planner_node)
     workflow.add_node("batch_processor", batch_processor_node)
-    workflow.set_entry_point("batch_processor")
-    workflow.add_edge("batch_processor", END)
+    workflow.add_node("reducer", reducer_node)
+    workflow.set_entry_point("planner")
+    workflow.add_conditional_edges("planner", dispatch_batches, ["batch_processor", "reducer"])
+    workflow.add_edge("batch_processor", "reducer")
+    workflow.add_edge("reducer", END)
     
     return workflow.compile()
 
-# Create the app instance
-app = build_batch_graph()
+@functools.lru_cache(maxsize=None)
+def get_graph_app():
+    """Compiles the graph on first use and reuses it afterwards."""
+    return build_batch_graph()
+
+def __getattr__(name):
+    # Keeps `from src.graph import app` working without compiling at import time
+    if name == "app":
+        return get_graph_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,185 @@
+import queue
+import random
+import socket
+import threading
+import time
+from typing import List, Dict, Optional
+from imap_tools import AND, U
+from .db_utils import save_emails, get_emails_by_ids
+from .ingestion import open_mailbox, message_to_email
+
+class IdleListener(threading.Thread):
+    """
+    Holds an IMAP IDLE connection on one mailbox folder and saves new messages as soon
+    as the server announces them. IDs of saved emails are put on new_email_queue.
+    Reconnects with exponential backoff (plus jitter) whenever the connection drops.
+    """
+
+    def __init__(self, username, password, server="imap.gmail.com", folder="INBOX", port=None, use_ssl=True,
+                 new_email_queue: Optional[queue.Queue] = None, idle_timeout: float = 25 * 60,
+                 initial_backoff: float = 1.0, max_backoff: float = 300.0):
+        super().__init__(daemon=True, name=f"idle-{username}-{folder}")
+        self.username = username
+        self.password = password
+        self.server = server
+        self.folder = folder
+        self.port = port
+        self.use_ssl = use_ssl
+        self.new_email_queue = new_email_queue if new_email_queue is not None else queue.Queue()
+        # Re-issue IDLE before servers drop it (RFC 2177: at least every 29 minutes)
+        self.idle_timeout = idle_timeout
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.last_uid = None
+        self.last_error = None
+        self._stop_event = threading.Event()
+        self._mailbox = None
+        self._mailbox_lock = threading.Lock()
+
+    def stop(self):
+        """Stops the listener, interrupting a blocking IDLE wait by shutting its socket down."""
+        self._stop_event.set()
+        with self._mailbox_lock:
+            if self._mailbox is not None:
+                try:
+                    self._mailbox.client.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def run(self):
+        backoff = self.initial_backoff
+        while not self._stop_event.is_set():
+            try:
+                with open_mailbox(self.username, self.password, self.server, self.folder, self.port, self.use_ssl) as mailbox:
+                    with self._mailbox_lock:
+                        self._mailbox = mailbox
+                    backoff = self.initial_backoff
+                    if self.last_uid is None:
+                        # Only messages arriving from now on; the backlog is what "Fetch" is for
+                        self.last_uid = int(mailbox.folder.status(self.folder)['UIDNEXT']) - 1
+                    # Catch up on anything that arrived while disconnected
+                    mailbox.client.untagged_responses.pop('EXISTS', None)
+                    self._fetch_new(mailbox)
+                    while not self._stop_event.is_set():
+                        # New mail announced alongside other responses (a fetch, leaving IDLE)
+                        # lands in the client's untagged responses instead of the IDLE poll
+                        if mailbox.client.untagged_responses.pop('EXISTS', None) or self._idle_wait(mailbox):
+                            self._fetch_new(mailbox)
+            except Exception as e:
+                if self._stop_event.is_set():
+                    # The socket was shut down by stop()
+                    break
+                self.last_error = str(e)
+                print(f"IMAP IDLE Error ({self.username}/{self.folder}): {e}. Reconnecting in {backoff:.0f}s")
+                self._stop_event.wait(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                with self._mailbox_lock:
+                    self._mailbox = None
+
+    def _idle_wait(self, mailbox):
+        """One IDLE command of up to idle_timeout seconds; returns the server's responses."""
+        with mailbox.idle as idle:
+            # A response sent along with the IDLE continuation can already sit in the client's
+            # read buffer, where polling the socket would not see it for the whole IDLE
+            if self._has_buffered_input(mailbox):
+                return [mailbox.client._get_line()]
+            return idle.poll(timeout=self.idle_timeout)
+
+    @staticmethod
+    def _has_buffered_input(mailbox) -> bool:
+        sock = mailbox.client.sock
+        old_timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(mailbox.client.file.peek(1))
+        except OSError:
+            return False
+        finally:
+            sock.settimeout(old_timeout)
+
+    def _fetch_new(self, mailbox):
+        """Fetches messages above the last seen UID, saves them and enqueues their IDs."""
+        new_emails = []
+        max_uid = self.last_uid
+        # "N:*" always matches the newest message, even if its UID is below N, hence the filter
+        for msg in mailbox.fetch(AND(uid=U(self.last_uid + 1, '*')), mark_seen=False, bulk=True):
+            if int(msg.uid) > self.last_uid:
+                new_emails.append(message_to_email(msg, self.username, self.folder))
+                max_uid = max(max_uid, int(msg.uid))
+
+        if new_emails:
+            save_emails(new_emails)
+            self.last_uid = max_uid
+            self.new_email_queue.put([e['id'] for e in new_emails])
+
+class ProcessingWorker(threading.Thread):
+    """
+    Drains the queue filled by IdleListeners and runs the agent on new emails.
+    Waits up to batch_window seconds after the first arrival so bursts share one batch.
+    """
+
+    def __init__(self, new_email_queue: queue.Queue, batch_size: int = 10, batch_window: float = 2.0):
+        super().__init__(daemon=True, name="idle-processor")
+        self.new_email_queue = new_email_queue
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        # Imported here so listening alone does not load the model stack
+        from .processor import process_emails
+        from .digest import start_digest_refresh
+
+        while not self._stop_event.is_set():
+            try:
+                email_ids = list(self.new_email_queue.get(timeout=1))
+            except queue.Empty:
+                continue
+
+            deadline = time.monotonic() + self.batch_window
+            while len(email_ids) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    email_ids.extend(self.new_email_queue.get(timeout=max(deadline - time.monotonic(), 0.01)))
+                except queue.Empty:
+                    break
+
+            try:
+                emails = get_emails_by_ids(email_ids, unprocessed_only=True)
+                if emails:
+                    stats = process_emails(emails, batch_size=self.batch_size)
+                    print(f"Processed {stats['processed']} new emails ({stats['reused']} reused from near-duplicates)")
+                    start_digest_refresh()
+            except Exception as e:
+                # Emails stay unprocessed and can be picked up by a regular run
+                print(f"Push processing error: {e}")
+
+def start_push_pipeline(sources: List[Dict], process: bool = True, **listener_options):
+    """
+    Starts one IdleListener per source ({username, password, server, folder, port, use_ssl})
+    and, if process is set, a ProcessingWorker consuming their queue.
+    Returns (listeners, worker); call stop() on each to shut down.
+    """
+    new_email_queue = queue.Queue()
+    listeners = []
+    for src in sources:
+        listener = IdleListener(
+            src['username'], src['password'],
+            server=src.get('server') or "imap.gmail.com",
+            folder=src.get('folder') or "INBOX",
+            port=src.get('port'),
+            use_ssl=src.get('use_ssl', True),
+            new_email_queue=new_email_queue,
+            **listener_options
+        )
+        listener.start()
+        listeners.append(listener)
+
+    worker = None
+    if process:
+        worker = ProcessingWorker(new_email_queue)
+        worker.start()
+    return listeners, worker
@@ -1,6 +1,9 @@
 import json
 import os
-from imap_tools import MailBox
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Callable
 from .db_utils import save_emails
 
 MOCK_INBOX_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'mock_inbox.json')
@@ -30,35 +33,54 @@ def fetch_emails_mock() -> int:
     save_emails(emails)
     return len(emails)
 
+def _header(msg, name):
+    values = msg.headers.get(name, ())
+    return values[0].strip() if values else None
+
+def make_email_id(username, folder, uid) -> str:
+    """IMAP UIDs are only unique within one folder, so IDs are namespaced by account and folder."""
+    return f"{username}:{folder}:{uid}"
+
+def message_to_email(msg, username, folder) -> dict:
+    """Converts an imap_tools message into the email dict stored in the database."""
+    return {
+        "id": make_email_id(username, folder, msg.uid),
+        "sender": msg.from_,
+        "subject": msg.subject,
+        "body": msg.text or msg.html,
+        "timestamp": msg.date.isoformat(),
+        "category": "",
+        "action_items": [],
+        "generated_draft": "",
+        "image_url": None, # IMAP fetch doesn't extract images yet
+        "is_processed": False,
+        "message_id": _header(msg, 'message-id'),
+        "in_reply_to": _header(msg, 'in-reply-to'),
+        "references": _header(msg, 'references'),
+        "account": username,
+        "folder": folder
+    }
+
+def open_mailbox(username, password, server="imap.gmail.com", folder="INBOX", port=None, use_ssl=True):
+    """Opens an authenticated IMAP connection on the given folder."""
+    from imap_tools import MailBox, MailBoxUnencrypted
+
+    mailbox_class = MailBox if use_ssl else MailBoxUnencrypted
+    mailbox = mailbox_class(server, port) if port else mailbox_class(server)
+    # If password is actually an access token (OAuth), use xoauth2
+    if len(password) > 100: # Simple heuristic for token vs password
+        return mailbox.xoauth2(username, password, initial_folder=folder)
+    # Standard Login
+    return mailbox.login(username, password, initial_folder=folder)
+
 def fetch_emails_imap(username, password, server="imap.gmail.com", folder="INBOX", limit=10) -> int:
     """Fetches emails from an IMAP server and saves them to the database. Default limit is 10."""
     new_emails = []
-    
-    def process_msg(msg):
-        return {
-            "id": str(msg.uid),
-            "sender": msg.from_,
-            "subject": msg.subject,
-            "body": msg.text or msg.html,
-            "timestamp": msg.date.isoformat(),
-            "category": "",
-            "action_items": [],
-            "generated_draft": "",
-            "image_url": None, # IMAP fetch doesn't extract images yet
-            "is_processed": False
-        }
 
     try:
-        # If password is actually an access token (OAuth), use xoauth2
-        if len(password) > 100: # Simple heuristic for token vs password
-            with MailBox(server).xoauth2(username, password, initial_folder=folder) as mailbox:
-                for msg in mailbox.fetch(limit=limit, reverse=True):
-                    new_emails.append(process_msg(msg))
-        else:
-            # Standard Login
-            with MailBox(server).login(username, password, initial_folder=folder) as mailbox:
-                for msg in mailbox.fetch(limit=limit, reverse=True):
-                    new_emails.append(process_msg(msg))
+        with open_mailbox(username, password, server, folder) as mailbox:
+            for msg in mailbox.fetch(limit=limit, reverse=True):
+                new_emails.append(message_to_email(msg, username, folder))
         
         if new_emails:
             save_emails(new_emails)
@@ -67,3 +89,55 @@ def fetch_emails_imap(username, password, server="imap.gmail.com", folder="INBOX
     except Exception as e:
         print(f"IMAP Error: {e}")
         raise e
+
+def build_sources(accounts: List[Dict], folders: List[str], limit: int = 10) -> List[Dict]:
+    """Expands accounts ({username, password, server}) x folders into sync sources."""
+    sources = []
+    for account in accounts:
+        for folder in folders:
+            sources.append({
+                "username": account['username'],
+                "password": account['password'],
+                "server": account.get('server') or "imap.gmail.com",
+                "folder": folder,
+                "limit": account.get('limit', limit)
+            })
+    return sources
+
+def sync_sources(sources: List[Dict], max_connections: int = 4, on_progress: Optional[Callable[[Dict], None]] = None) -> List[Dict]:
+    """
+    Fetches many account/folder sources concurrently, with at most max_connections
+    IMAP connections open at a time, so total time tracks the slowest mailbox.
+    A failing source does not stop the others; each source gets a status entry
+    ({account, folder, state, fetched, error, elapsed}) that is passed to on_progress
+    whenever it changes. Returns the list of status entries.
+    """
+    statuses = [
+        {"account": src['username'], "folder": src['folder'], "state": "pending", "fetched": 0, "error": None, "elapsed": 0.0}
+        for src in sources
+    ]
+    lock = threading.Lock()
+
+    def report(status):
+        if on_progress:
+            with lock:
+                on_progress(dict(status))
+
+    def sync_one(src, status):
+        status['state'] = "running"
+        report(status)
+        started = time.perf_counter()
+        try:
+            status['fetched'] = fetch_emails_imap(src['username'], src['password'], src['server'], src['folder'], src['limit'])
+            status['state'] = "done"
+        except Exception as e:
+            status['state'] = "error"
+            status['error'] = str(e)
+        status['elapsed'] = time.perf_counter() - started
+        report(status)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_connections, len(sources) or 1))) as pool:
+        for future in [pool.submit(sync_one, src, status) for src, status in zip(sources, statuses)]:
+            future.result()
+
+    return statuses
@@ -1,61 +1,253 @@
+from typing import List, Dict, Any, Optional, Callable
+import threading
+from src.graph import get_graph_app, RESULT_FIELDS, DEFAULT_MAX_CONCURRENCY, set_max_concurrency
+from src.db_utils import (get_prompts, get_threads, get_thread_email_summaries, get_clusters, get_processed_email_ids,
+                          copy_email_result, get_prompt_versions, get_stale_emails, get_pending_draft_emails)
+from src.threads import strip_quoted_text
 
-import streamlit as st
-from typing import List, Dict, Any
-from src.graph import app as graph_app
-from src.db_utils import update_email_result, get_prompts
+DRAFT_FIELD = "generated_draft"
+# Fields of a batch run when drafts are generated on demand instead
+LAZY_DRAFT_FIELDS = [f for f in RESULT_FIELDS if f != DRAFT_FIELD]
+# Categories likely to need a reply; their drafts are worth prefetching
+REPLY_CATEGORIES = ["Work", "Personal"]
 
-def process_email_batch(emails: List[Dict[str, Any]], batch_size: int = 10):
+def _group_by_thread(emails: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Orders emails so each thread's messages are adjacent and chronological."""
+    first_seen = {}
+    for index, email in enumerate(emails):
+        first_seen.setdefault(email.get('thread_id') or email['id'], index)
+    return sorted(emails, key=lambda e: (first_seen[e.get('thread_id') or e['id']], e.get('timestamp') or ''))
+
+def _split_near_duplicates(emails: List[Dict[str, Any]]):
+    """
+    Splits emails into those that need the model and near-duplicates that can reuse a result.
+    Returns (emails_to_process, reuse) where reuse maps a source email ID to the IDs copying its result.
+    """
+    clusters = get_clusters([e['id'] for e in emails])
+    processed_representatives = set(get_processed_email_ids(list(set(clusters.values()))))
+
+    to_process = []
+    reuse = {}
+    cluster_sources = {}
+    for email in emails:
+        cluster_id = clusters.get(email['id'], email['id'])
+        if cluster_id != email['id'] and cluster_id in processed_representatives:
+            # Representative already processed earlier: reuse its result directly
+            reuse.setdefault(cluster_id, []).append(email['id'])
+        elif cluster_id in cluster_sources:
+            # Another member of this cluster is in this run: only that one goes to the model
+            reuse.setdefault(cluster_sources[cluster_id], []).append(email['id'])
+        else:
+            cluster_sources[cluster_id] = email['id']
+            to_process.append(email)
+    return to_process, reuse
+
+def process_emails(emails: List[Dict[str, Any]], batch_size: int = 10, reuse_near_duplicates: bool = False,
+                   fields: Optional[List[str]] = None, max_concurrency: Optional[int] = None, lazy_drafts: bool = False,
+                   on_start: Optional[Callable[[int, int], None]] = None,
+                   on_batch_done: Optional[Callable[[int, int], None]] = None,
+                   on_error: Optional[Callable[[Exception], None]] = None) -> Dict[str, int]:
     """
-    Processes a list of emails in batches using the LangGraph agent.
-    Updates the database with the results.
+    Processes a list of emails with the LangGraph agent, without any UI.
+    The whole list goes through one graph run, which splits it into sub-batches and
+    runs up to max_concurrency model calls in parallel; each sub-batch is saved as soon as it finishes.
+    Messages of the same thread are sent together, quote-stripped, along with
+    the thread's cached rolling summary instead of the full history.
+    With reuse_near_duplicates, only one email per near-duplicate cluster is sent
+    to the model and the others copy its category, and its summary where the numbers match.
+    With fields, only those result fields are requested and updated (reprocessing).
+    With lazy_drafts, no drafts are written; they are generated later by generate_drafts.
+    Returns {processed, reused, failed_batches}, counting only emails whose results were saved.
     """
+    partial = fields is not None and set(fields) != set(RESULT_FIELDS)
+    if lazy_drafts and not partial:
+        fields = LAZY_DRAFT_FIELDS
+    reuse = {}
+    if reuse_near_duplicates and not partial:
+        emails, reuse = _split_near_duplicates(emails)
+    emails = _group_by_thread(emails)
     total_emails = len(emails)
+    failed_batches = 0
+
+    threads = {}
+    if not partial:
+        thread_rows = get_threads({email['thread_id'] for email in emails if email.get('thread_id')})
+        threads = {
+            thread_id: row.get('summary') or ''
+            for thread_id, row in thread_rows.items()
+            if row.get('message_count', 0) > 1
+        }
+        # Threads whose earlier messages were processed before they had a rolling summary
+        # start from those messages' own summaries
+        unsummarized = [thread_id for thread_id, summary in threads.items() if not summary]
+        earlier = get_thread_email_summaries(unsummarized, [email['id'] for email in emails])
+        for thread_id, entries in earlier.items():
+            threads[thread_id] = " ".join(f"{entry['sender']}: {entry['summary']}" for entry in entries)
+
+    # Prepare Graph Input
+    batch_input_data = []
+    seen_threads = set()
+    for email in emails:
+        thread_id = email.get('thread_id')
+        # Quoted history is only dropped when the prompt carries it otherwise: as the
+        # thread summary or as an earlier message of this run
+        strip_quotes = thread_id in threads and (bool(threads[thread_id]) or thread_id in seen_threads)
+        seen_threads.add(thread_id)
+        batch_input_data.append({
+            "id": email['id'],
+            "content": strip_quoted_text(email['body']) if strip_quotes else email['body'],
+            "sender": email['sender'],
+            "image_url": email.get('image_url'),
+            "thread_id": email.get('thread_id')
+        })
+
+    initial_state = {
+        "emails": batch_input_data,
+        "results": {},
+        "user_prompts": get_prompts(),
+        "threads": threads,
+        "fields": fields or RESULT_FIELDS,
+        "partial": partial,
+        "batch_size": batch_size,
+        "persist": True,
+        "prompt_versions": get_prompt_versions(),
+        "completed": [],
+        "errors": [],
+        "failed": []
+    }
+    if max_concurrency:
+        set_max_concurrency(max_concurrency)
+    max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+
+    # Stream node updates so progress is reported as each parallel batch finishes
+    done = 0
+    persisted = 0
+    try:
+        for update in get_graph_app().stream(initial_state, config={"max_concurrency": max_concurrency}, stream_mode="updates"):
+            for node, output in update.items():
+                output = output or {}
+                if node == "planner" and on_start:
+                    on_start(len(output.get('batches', [])), total_emails)
+                elif node == "batch_processor":
+                    done += len(output.get('completed', []))
+                    persisted += output.get('persisted', 0)
+                    for error in output.get('errors', []):
+                        failed_batches += 1
+                        if on_error:
+                            on_error(Exception(error))
+                    if on_batch_done:
+                        on_batch_done(done, total_emails)
+    except Exception as e:
+        failed_batches += 1
+        if on_error:
+            on_error(e)
+        else:
+            print(f"Error processing batch: {e}")
+
+    reused = 0
+    for source_id, target_ids in reuse.items():
+        reused += copy_email_result(source_id, target_ids)
+
+    return {"processed": persisted, "reused": reused, "failed_batches": failed_batches}
+
+def reprocess_stale_emails(batch_size: int = 10, **options) -> Dict[str, int]:
+    """
+    Regenerates only the fields whose prompt changed since they were produced.
+    Emails are grouped by their set of stale fields so e.g. a categorization edit
+    results in category-only batches with much smaller outputs.
+    """
+    groups = {}
+    for email in get_stale_emails():
+        groups.setdefault(tuple(email['stale_fields']), []).append(email)
+
+    totals = {"processed": 0, "reused": 0, "failed_batches": 0}
+    for stale_fields, group in groups.items():
+        stats = process_emails(group, batch_size=batch_size, fields=list(stale_fields), **options)
+        for key in totals:
+            totals[key] += stats[key]
+    return totals
+
+def generate_drafts(emails: List[Dict[str, Any]], batch_size: int = 10, **options) -> Dict[str, int]:
+    """Generates and stores drafts for processed emails, e.g. when a user opens one in the inbox."""
+    return process_emails(emails, batch_size=batch_size, fields=[DRAFT_FIELD], **options)
+
+def prefetch_drafts(categories: Optional[List[str]] = None, limit: Optional[int] = None,
+                    batch_size: int = 10, **options) -> Dict[str, int]:
+    """Generates pending drafts for the reply-likely categories (REPLY_CATEGORIES by default)."""
+    emails = get_pending_draft_emails(categories or REPLY_CATEGORIES, limit)
+    if not emails:
+        return {"processed": 0, "reused": 0, "failed_batches": 0}
+    return generate_drafts(emails, batch_size=batch_size, **options)
+
+# At most one prefetch thread per process, so no draft is generated twice
+_prefetch_lock = threading.Lock()
+_prefetch_thread = None
+_prefetch_requested = False
+
+def start_draft_prefetch(categories: Optional[List[str]] = None, limit: Optional[int] = None) -> threading.Thread:
+    """
+    Runs prefetch_drafts in a daemon thread so the caller does not wait for the drafts.
+    While a prefetch is running, no second one starts; the running thread makes one more
+    pass when it is done (to pick up emails processed meanwhile) and is returned instead.
+    """
+    global _prefetch_thread, _prefetch_requested
+
+    def run():
+        global _prefetch_thread, _prefetch_requested
+        while True:
+            try:
+                stats = prefetch_drafts(categories, limit)
+                print(f"Prefetched drafts for {stats['processed']} emails")
+            except Exception as e:
+                # Drafts stay pending and are generated on demand instead
+                print(f"Draft prefetch error: {e}")
+            with _prefetch_lock:
+                if not _prefetch_requested:
+                    _prefetch_thread = None
+                    return
+                _prefetch_requested = False
+
+    with _prefetch_lock:
+        if _prefetch_thread is not None:
+            _prefetch_requested = True
+            return _prefetch_thread
+        _prefetch_thread = threading.Thread(target=run, daemon=True, name="draft-prefetch")
+        _prefetch_thread.start()
+        return _prefetch_thread
+
+def _streamlit_callbacks():
+    """Progress bar, status line and error callbacks for running the pipeline inside the UI."""
+    # Only the UI wrappers need Streamlit; headless callers never import it
+    import streamlit as st
+
     progress_bar = st.progress(0)
     status_text = st.empty()
-    
-    current_prompts = get_prompts()
-    
-    for i in range(0, total_emails, batch_size):
-        batch_emails = emails[i : i + batch_size]
-        status_text.text(f"Processing batch {i//batch_size + 1} (emails {i+1}-{min(i+batch_size, total_emails)})...")
-        
-        # Prepare Batch Input (Single State)
-        batch_input_data = []
-        for email in batch_emails:
-            batch_input_data.append({
-                "id": email['id'],
-                "content": email['body'],
-                "sender": email['sender'],
-                "image_url": email.get('image_url')
-            })
-        
-        initial_state = {
-            "emails": batch_input_data,
-            "results": {},
-            "user_prompts": current_prompts
-        }
-        
-        # Invoke Graph (Single Call for Batch)
-        try:
-            output_state = graph_app.invoke(initial_state)
-            results = output_state.get("results", {})
-            
-            # Update DB with results
-            for email in batch_emails:
-                # Get result for this specific email ID
-                res = results.get(email['id'], {})
-                
-                update_email_result(
-                    email['id'],
-                    res.get('category', 'Uncategorized'),
-                    res.get('action_items', []),
-                    res.get('generated_draft', ''),
-                    res.get('summary', '')
-                )
-                
-        except Exception as e:
-            st.error(f"Error processing batch: {e}")
-        
-        progress_bar.progress(min((i + batch_size) / total_emails, 1.0))
-    
-    status_text.text("Processing complete!")
+    callbacks = {
+        "on_start": lambda batches, total: status_text.text(f"Processing {total} emails in {batches} parallel batches..."),
+        "on_batch_done": lambda done, total: progress_bar.progress(min(done / total, 1.0)),
+        "on_error": lambda e: st.error(f"Error processing batch: {e}")
+    }
+    return callbacks, progress_bar, status_text
+
+def process_email_batch(emails: List[Dict[str, Any]], batch_size: int = 10, reuse_near_duplicates: bool = False,
+                        max_concurrency: Optional[int] = None, lazy_drafts: bool = False):
+    """
+    Processes a list of emails in batches using the LangGraph agent,
+    reporting progress in the Streamlit UI.
+    """
+    callbacks, progress_bar, status_text = _streamlit_callbacks()
+    stats = process_emails(emails, batch_size=batch_size, reuse_near_duplicates=reuse_near_duplicates,
+                           max_concurrency=max_concurrency, lazy_drafts=lazy_drafts, **callbacks)
+    progress_bar.progress(1.0)
+
+    message = f"Processing complete! Saved results for {stats['processed']} emails."
+    if stats['reused']:
+        message += f" Reused results for {stats['reused']} near-duplicate emails."
+    status_text.text(message)
+
+def reprocess_stale_batch(batch_size: int = 10):
+    """Regenerates stale fields after prompt edits, reporting progress in the Streamlit UI."""
+    callbacks, progress_bar, status_text = _streamlit_callbacks()
+    stats = reprocess_stale_emails(batch_size=batch_size, **callbacks)
+    progress_bar.progress(1.0)
+    status_text.text(f"Reprocessing complete! Updated {stats['processed']} emails.")
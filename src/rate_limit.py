@@ -0,0 +1,173 @@
+import os
+import random
+import re
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Free-tier defaults for gemini-2.5-flash-lite; override per deployment
+DEFAULT_REQUESTS_PER_MINUTE = int(os.environ.get("EMAIL_AGENT_RPM", "15"))
+DEFAULT_TOKENS_PER_MINUTE = int(os.environ.get("EMAIL_AGENT_TPM", "250000"))
+
+# Rough token cost of one attached image
+IMAGE_TOKENS = 258
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_ERROR_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout",
+}
+RETRY_AFTER_PATTERNS = [
+    re.compile(r'retry in ([\d.]+)\s*s', re.IGNORECASE),
+    re.compile(r'retry_delay\s*\{\s*seconds:\s*(\d+)', re.IGNORECASE),
+    re.compile(r'retry-after:?\s*([\d.]+)', re.IGNORECASE),
+]
+
+class RateLimiter:
+    """
+    Token-bucket limiter over requests/min and tokens/min, shared by every model caller.
+    acquire() blocks until both buckets can cover the call; pause() stops all callers
+    (e.g. after a 429) until the given delay has passed.
+    """
+
+    def __init__(self, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE):
+        self.requests_per_minute = max(1, requests_per_minute)
+        self.tokens_per_minute = max(1, tokens_per_minute)
+        self._request_tokens = float(self.requests_per_minute)
+        self._llm_tokens = float(self.tokens_per_minute)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        self._request_tokens = min(self.requests_per_minute, self._request_tokens + elapsed * self.requests_per_minute / 60)
+        self._llm_tokens = min(self.tokens_per_minute, self._llm_tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens: int = 0):
+        """Blocks until one request carrying roughly `tokens` tokens fits under both limits."""
+        # A single oversized call would otherwise wait forever
+        tokens = min(max(tokens, 0), self.tokens_per_minute)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    request_wait = (1 - self._request_tokens) * 60 / self.requests_per_minute
+                    token_wait = (tokens - self._llm_tokens) * 60 / self.tokens_per_minute
+                    wait = max(request_wait, token_wait)
+                    if wait <= 0:
+                        self._request_tokens -= 1
+                        self._llm_tokens -= tokens
+                        return
+            time.sleep(wait)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """Corrects the token bucket once the real usage of a call is known."""
+        with self._lock:
+            self._llm_tokens -= actual_tokens - estimated_tokens
+
+    def pause(self, seconds: float):
+        """Holds back every caller for `seconds` (the server asked us to slow down)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+def get_rate_limiter() -> RateLimiter:
+    """Process-wide limiter shared by the batch graph and the chat."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
+
+def estimate_tokens(content) -> int:
+    """Rough input-token estimate (~4 characters per token) for text or multimodal content parts."""
+    if isinstance(content, str):
+        return len(content) // 4 + 1
+    total = 0
+    for part in content or []:
+        if isinstance(part, dict) and part.get("type") == "image_url":
+            total += IMAGE_TOKENS
+        elif isinstance(part, dict):
+            total += estimate_tokens(part.get("text", ""))
+        else:
+            total += estimate_tokens(str(part))
+    return total
+
+def _status_code(error: Exception) -> Optional[int]:
+    for attr in ("status_code", "code", "status"):
+        value = getattr(error, attr, None)
+        value = value() if callable(value) else value
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+def is_retryable(error: Exception) -> bool:
+    """Quota (429) and transient server/network errors are retried; everything else is not."""
+    if _status_code(error) in RETRYABLE_STATUS_CODES or type(error).__name__ in RETRYABLE_ERROR_NAMES:
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    message = str(error).lower()
+    return "429" in message or "resource_exhausted" in message or "rate limit" in message or "quota" in message
+
+def is_quota_error(error: Exception) -> bool:
+    message = str(error).lower()
+    return _status_code(error) == 429 or type(error).__name__ in ("ResourceExhausted", "TooManyRequests") \
+        or "429" in message or "resource_exhausted" in message
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Reads the server's requested delay from a Retry-After header or the error message."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    message = str(error)
+    for pattern in RETRY_AFTER_PATTERNS:
+        match = pattern.search(message)
+        if match:
+            return float(match.group(1))
+    return None
+
+def call_with_retry(fn: Callable[[], T], estimated_tokens: int = 0, max_retries: int = 5,
+                    base_delay: float = 1.0, max_delay: float = 60.0,
+                    limiter: Optional[RateLimiter] = None) -> T:
+    """
+    Calls fn() under the shared rate limiter, retrying quota and transient errors with
+    exponential backoff and full jitter. A server-provided Retry-After takes precedence,
+    and quota errors pause all callers so the process backs off as a whole.
+    """
+    limiter = limiter or get_rate_limiter()
+    for attempt in range(max_retries + 1):
+        limiter.acquire(estimated_tokens)
+        try:
+            result = fn()
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            if is_quota_error(e):
+                limiter.pause(delay)
+            print(f"Model call failed ({e.__class__.__name__}), retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        usage = getattr(result, "usage_metadata", None)
+        if isinstance(usage, dict) and usage.get("total_tokens"):
+            limiter.settle(estimated_tokens, usage["total_tokens"])
+        return result
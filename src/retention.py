@@ -0,0 +1,261 @@
+import json
+import os
+import sqlite3
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+from . import db_utils
+from .db_utils import get_db_connection, save_emails, update_email_results, bump_change_counter, EMAILS_SCOPE
+
+# Cold emails live in a separate SQLite file next to the main database
+ARCHIVE_DB_PATH = "email_archive.db"
+
+# Emails moved per transaction, so the main database is never locked for long
+ARCHIVE_CHUNK = 500
+
+# A policy archives emails matching all of its conditions:
+#   older_than_days: age by email timestamp
+#   categories:      only these categories (None = any)
+#   processed_only:  leave unprocessed emails in the inbox
+DEFAULT_POLICIES = [
+    {"older_than_days": 30, "categories": ["Spam", "Newsletter"], "processed_only": True},
+    {"older_than_days": 180, "categories": None, "processed_only": True},
+]
+
+# Columns copied to the archive as they are; the body is stored compressed
+ARCHIVED_COLUMNS = [
+    "id", "sender", "subject", "timestamp", "image_url", "is_processed", "category", "action_items",
+    "generated_draft", "summary", "message_id", "in_reply_to", "references_header", "thread_id",
+    "account", "folder", "categorization_version", "extraction_version", "auto_reply_version",
+]
+
+def _compress(text: Optional[str]) -> Optional[bytes]:
+    return zlib.compress(text.encode("utf-8"), 6) if text is not None else None
+
+def _decompress(blob: Optional[bytes]) -> str:
+    return zlib.decompress(blob).decode("utf-8") if blob else ""
+
+def _archive_path() -> str:
+    # Kept alongside the main database, wherever that is configured
+    return os.path.join(os.path.dirname(db_utils.DB_PATH), ARCHIVE_DB_PATH)
+
+def get_archive_connection():
+    conn = sqlite3.connect(_archive_path(), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.create_function("unzip_body", 1, _decompress, deterministic=True)
+    return conn
+
+def init_archive():
+    """Create the archive database and switch the main one to incremental vacuum."""
+    conn = get_archive_connection()
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_emails (
+            id TEXT PRIMARY KEY,
+            sender TEXT,
+            subject TEXT,
+            timestamp TEXT,
+            image_url TEXT,
+            is_processed BOOLEAN,
+            category TEXT,
+            action_items TEXT,
+            generated_draft TEXT,
+            summary TEXT,
+            message_id TEXT,
+            in_reply_to TEXT,
+            references_header TEXT,
+            thread_id TEXT,
+            account TEXT,
+            folder TEXT,
+            categorization_version INTEGER,
+            extraction_version INTEGER,
+            auto_reply_version INTEGER,
+            body_z BLOB,
+            archived_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_timestamp ON archived_emails(timestamp)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_category ON archived_emails(category)')
+    conn.commit()
+    conn.close()
+
+    conn = get_db_connection()
+    # Archives written before the main database kept tombstones of archived IDs
+    conn.execute('ATTACH DATABASE ? AS archive', (_archive_path(),))
+    conn.execute('INSERT OR IGNORE INTO archived_ids (id) SELECT id FROM archive.archived_emails')
+    conn.commit()
+    conn.execute('DETACH DATABASE archive')
+    # auto_vacuum can only change on an existing database through a full VACUUM; done once
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+    conn.close()
+
+def _policy_condition(policy: Dict, now: datetime):
+    """SQL condition (and params) selecting the emails a policy archives."""
+    cutoff = (now - timedelta(days=policy.get("older_than_days") or 0)).strftime("%Y-%m-%d")
+    # Emails without a timestamp have no age and are never archived
+    conditions = ["timestamp != ''", "timestamp < ?"]
+    params = [cutoff]
+    if policy.get("categories"):
+        conditions.append(f'category IN ({",".join("?" * len(policy["categories"]))})')
+        params.extend(policy["categories"])
+    if policy.get("processed_only", True):
+        conditions.append("is_processed = 1")
+    return "(" + " AND ".join(conditions) + ")", params
+
+def find_archivable(policies: Optional[List[Dict]] = None, now: Optional[datetime] = None) -> List[str]:
+    """IDs of emails matching any of the retention policies."""
+    policies = DEFAULT_POLICIES if policies is None else policies
+    if not policies:
+        return []
+    now = now or datetime.now(timezone.utc)
+    clauses, params = [], []
+    for policy in policies:
+        clause, clause_params = _policy_condition(policy, now)
+        clauses.append(clause)
+        params.extend(clause_params)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT id FROM emails WHERE {" OR ".join(clauses)} ORDER BY timestamp', params)
+    email_ids = [row['id'] for row in cursor.fetchall()]
+    conn.close()
+    return email_ids
+
+def _archive_chunk(email_ids: List[str]) -> int:
+    """Moves one chunk of emails to the archive in a single transaction across both files."""
+    conn = get_db_connection()
+    conn.create_function("zip_body", 1, _compress, deterministic=True)
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS archive', (_archive_path(),))
+    try:
+        cursor.execute('BEGIN')
+        placeholders = ",".join("?" * len(email_ids))
+        columns = ", ".join(ARCHIVED_COLUMNS)
+        cursor.execute(f'''
+            INSERT OR REPLACE INTO archive.archived_emails ({columns}, body_z, archived_at)
+            SELECT {columns}, zip_body(body), ? FROM emails WHERE id IN ({placeholders})
+        ''', [datetime.now(timezone.utc).isoformat()] + email_ids)
+        moved = cursor.rowcount
+
+        cursor.execute(f'SELECT DISTINCT thread_id FROM emails WHERE id IN ({placeholders})', email_ids)
+        thread_ids = [row['thread_id'] for row in cursor.fetchall() if row['thread_id']]
+
+        cursor.execute(f'INSERT OR IGNORE INTO archived_ids (id) SELECT id FROM emails WHERE id IN ({placeholders})', email_ids)
+        cursor.execute(f'DELETE FROM signature_bands WHERE email_id IN ({placeholders})', email_ids)
+        cursor.execute(f'DELETE FROM email_signatures WHERE email_id IN ({placeholders})', email_ids)
+        cursor.execute(f'DELETE FROM emails WHERE id IN ({placeholders})', email_ids)
+        # Thread rows stay (their summaries remain useful context); only the counts shrink
+        if thread_ids:
+            cursor.execute(f'''
+                UPDATE threads SET message_count = (SELECT COUNT(*) FROM emails WHERE emails.thread_id = threads.thread_id)
+                WHERE thread_id IN ({",".join("?" * len(thread_ids))})
+            ''', thread_ids)
+        bump_change_counter(cursor, EMAILS_SCOPE)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute('DETACH DATABASE archive')
+        conn.close()
+    return moved
+
+def incremental_vacuum(max_pages: int = 0) -> int:
+    """Returns free pages to the filesystem (all of them when max_pages is 0). Returns pages freed."""
+    conn = get_db_connection()
+    before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.execute(f'PRAGMA incremental_vacuum({int(max_pages)})' if max_pages else 'PRAGMA incremental_vacuum')
+    after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.close()
+    return before - after
+
+def run_retention(policies: Optional[List[Dict]] = None, dry_run: bool = False, chunk_size: int = ARCHIVE_CHUNK) -> Dict[str, int]:
+    """
+    Moves emails matching the retention policies to the archive, then reclaims the
+    space they used in the main database. Returns {matched, archived, pages_freed}.
+    """
+    email_ids = find_archivable(policies)
+    if dry_run or not email_ids:
+        return {"matched": len(email_ids), "archived": 0, "pages_freed": 0}
+
+    init_archive()
+    archived = 0
+    for i in range(0, len(email_ids), chunk_size):
+        archived += _archive_chunk(email_ids[i:i + chunk_size])
+    return {"matched": len(email_ids), "archived": archived, "pages_freed": incremental_vacuum()}
+
+def _archived_email(row) -> Dict:
+    email = {key: row[key] for key in row.keys() if key != 'body_z'}
+    email['body'] = _decompress(row['body_z'])
+    try:
+        email['action_items'] = json.loads(email['action_items']) if email['action_items'] else []
+    except Exception:
+        email['action_items'] = []
+    return email
+
+def search_archive(query: str, limit: int = 50, search_body: bool = False) -> List[Dict]:
+    """
+    Searches archived emails by sender, subject and summary (and the compressed
+    bodies if search_body is set, which is slower). Newest first, bodies included.
+    """
+    if not os.path.exists(_archive_path()):
+        return []
+    pattern = f"%{query}%"
+    conditions = ["sender LIKE ?", "subject LIKE ?", "summary LIKE ?"]
+    if search_body:
+        conditions.append("unzip_body(body_z) LIKE ?")
+    conn = get_archive_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT * FROM archived_emails WHERE {" OR ".join(conditions)}
+        ORDER BY timestamp DESC LIMIT ?
+    ''', [pattern] * len(conditions) + [limit])
+    emails = [_archived_email(row) for row in cursor.fetchall()]
+    conn.close()
+    return emails
+
+def restore_emails(email_ids: List[str]) -> int:
+    """Moves archived emails back into the inbox with their processing results."""
+    if not email_ids or not os.path.exists(_archive_path()):
+        return 0
+    placeholders = ",".join("?" * len(email_ids))
+    conn = get_archive_connection()
+    cursor = conn.cursor()
+    cursor.execute(f'SELECT * FROM archived_emails WHERE id IN ({placeholders})', email_ids)
+    emails = [_archived_email(row) for row in cursor.fetchall()]
+    conn.close()
+    if not emails:
+        return 0
+
+    for email in emails:
+        # save_emails reads the header under its ingestion name
+        email['references'] = email.get('references_header')
+    # Lift the tombstones first, or save_emails would skip the emails as archived
+    conn = get_db_connection()
+    conn.execute(f'DELETE FROM archived_ids WHERE id IN ({",".join("?" * len(emails))})', [e['id'] for e in emails])
+    conn.commit()
+    conn.close()
+    save_emails(emails)
+    processed = [e for e in emails if e.get('is_processed')]
+    if processed:
+        update_email_results(processed)
+
+    conn = get_archive_connection()
+    conn.execute(f'DELETE FROM archived_emails WHERE id IN ({placeholders})', [e['id'] for e in emails])
+    conn.commit()
+    conn.close()
+    return len(emails)
+
+def get_archive_stats() -> Dict[str, int]:
+    """Number of archived emails and the archive file size in bytes."""
+    if not os.path.exists(_archive_path()):
+        return {"emails": 0, "bytes": 0}
+    conn = get_archive_connection()
+    try:
+        count = conn.execute('SELECT COUNT(*) FROM archived_emails').fetchone()[0]
+    except sqlite3.OperationalError:
+        count = 0
+    conn.close()
+    return {"emails": count, "bytes": os.path.getsize(_archive_path())}
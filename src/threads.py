@@ -0,0 +1,44 @@
+import re
+from typing import List, Optional
+
+# Matches "<local@domain>" style identifiers in Message-ID / In-Reply-To / References headers
+MESSAGE_ID_RE = re.compile(r'<[^<>\s]+>')
+
+# Reply/forward prefixes stripped when grouping subjects ("Re: Re: Fwd: Budget" -> "Budget")
+SUBJECT_PREFIX_RE = re.compile(r'^\s*((re|fwd?|aw|sv)\s*(\[\d+\])?\s*:\s*)+', re.IGNORECASE)
+
+# Common "On <date>, <someone> wrote:" attribution lines that introduce quoted history
+ATTRIBUTION_RE = re.compile(r'^\s*On .+wrote:\s*$', re.IGNORECASE)
+FORWARD_MARKERS = ("-----original message-----", "---------- forwarded message")
+
+def parse_message_ids(header_value: Optional[str]) -> List[str]:
+    """Extracts message identifiers from a raw header value, preserving order."""
+    if not header_value:
+        return []
+    ids = MESSAGE_ID_RE.findall(header_value)
+    if not ids and header_value.strip():
+        # Some servers omit the angle brackets
+        ids = header_value.split()
+    return ids
+
+def normalize_subject(subject: Optional[str]) -> str:
+    """Removes reply/forward prefixes so all messages of a thread share a subject."""
+    return SUBJECT_PREFIX_RE.sub('', subject or '').strip()
+
+def strip_quoted_text(body: Optional[str]) -> str:
+    """Returns only the new part of a reply, dropping quoted history below it."""
+    if not body:
+        return ""
+
+    new_lines = []
+    for line in body.splitlines():
+        stripped = line.strip()
+        if ATTRIBUTION_RE.match(line) or stripped.lower().startswith(FORWARD_MARKERS):
+            break
+        if stripped.startswith('>'):
+            continue
+        new_lines.append(line)
+
+    new_text = "\n".join(new_lines).strip()
+    # Fall back to the full body if the whole message was quoted (e.g. a bare forward)
+    return new_text or body
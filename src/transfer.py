@@ -0,0 +1,176 @@
+import hashlib
+import json
+import mailbox
+import os
+from email import policy
+from email.parser import BytesParser
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional
+from .db_utils import save_emails, update_email_results, iter_emails
+
+DEFAULT_CHUNK_SIZE = 500
+EXPORT_FORMATS = ["jsonl", "parquet"]
+IMPORT_FORMATS = ["jsonl", "mbox"]
+
+# Columns written by an export, in order
+EXPORT_FIELDS = [
+    "id", "sender", "subject", "timestamp", "account", "folder",
+    "message_id", "in_reply_to", "references_header", "thread_id",
+    "is_processed", "category", "action_items", "generated_draft", "summary",
+    "categorization_version", "extraction_version", "auto_reply_version", "image_url", "body",
+]
+RESULT_FIELDS = ("category", "action_items", "generated_draft", "summary")
+
+def detect_format(path: str, fmt: Optional[str] = None) -> Optional[str]:
+    """The given format, or the one implied by the file extension (None if it implies none)."""
+    if fmt:
+        return fmt
+    extension = os.path.splitext(path)[1].lower()
+    return {".jsonl": "jsonl", ".parquet": "parquet", ".mbox": "mbox"}.get(extension)
+
+def _export_row(email: Dict, include_body: bool) -> Dict:
+    row = {field: email.get(field) for field in EXPORT_FIELDS if include_body or field != "body"}
+    row["is_processed"] = bool(row["is_processed"])
+    return row
+
+def export_jsonl(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, processed_only: bool = False, include_body: bool = True) -> int:
+    """Streams emails and their results to a JSONL file, one chunk of rows at a time."""
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for chunk in iter_emails(chunk_size, processed_only):
+            f.writelines(json.dumps(_export_row(email, include_body), ensure_ascii=False) + "\n" for email in chunk)
+            count += len(chunk)
+    return count
+
+def export_parquet(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, processed_only: bool = False, include_body: bool = True) -> int:
+    """Streams emails and their results to a Parquet file, one row group per chunk. Requires pyarrow."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet export requires pyarrow: pip install pyarrow")
+
+    fields = [
+        pa.field("id", pa.string()), pa.field("sender", pa.string()), pa.field("subject", pa.string()),
+        pa.field("timestamp", pa.string()), pa.field("account", pa.string()), pa.field("folder", pa.string()),
+        pa.field("message_id", pa.string()), pa.field("in_reply_to", pa.string()),
+        pa.field("references_header", pa.string()), pa.field("thread_id", pa.string()), pa.field("is_processed", pa.bool_()), pa.field("category", pa.string()),
+        pa.field("action_items", pa.list_(pa.string())), pa.field("generated_draft", pa.string()),
+        pa.field("summary", pa.string()), pa.field("categorization_version", pa.int64()),
+        pa.field("extraction_version", pa.int64()), pa.field("auto_reply_version", pa.int64()),
+        pa.field("image_url", pa.string()), pa.field("body", pa.string()),
+    ]
+    schema = pa.schema([f for f in fields if include_body or f.name != "body"])
+
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter_emails(chunk_size, processed_only):
+            rows = [_export_row(email, include_body) for email in chunk]
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            count += len(rows)
+    return count
+
+def export_emails(path: str, fmt: Optional[str] = None, **options) -> int:
+    """Exports emails and processing results to JSONL or Parquet (chosen by extension by default)."""
+    fmt = detect_format(path, fmt)
+    if fmt == "parquet":
+        return export_parquet(path, **options)
+    if fmt == "jsonl":
+        return export_jsonl(path, **options)
+    raise ValueError(f"Unsupported export format: {fmt}")
+
+def iter_jsonl(path: str) -> Iterator[Dict]:
+    """Reads a JSONL dump (e.g. a previous export) line by line."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {line_no} of {path}: {e}")
+
+def _mbox_body(msg) -> str:
+    part = msg.get_body(preferencelist=("plain", "html"))
+    if part is None:
+        return ""
+    try:
+        return part.get_content()
+    except Exception:
+        return part.get_payload(decode=True).decode("utf-8", errors="replace")
+
+def _content_id(sender: str, date: str, subject: str, body: str) -> str:
+    """Stable ID for a message without a Message-ID, the same whichever file or position it comes from."""
+    content = "\n".join([sender, date, subject, body]).encode("utf-8", errors="replace")
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+def iter_mbox(path: str) -> Iterator[Dict]:
+    """Reads an mbox dump message by message, converting each to an email dict."""
+    box = mailbox.mbox(path, factory=lambda f: BytesParser(policy=policy.default).parse(f), create=False)
+    for msg in box:
+        message_id = (msg.get("Message-ID") or "").strip()
+        date = str(msg.get("Date", ""))
+        try:
+            timestamp = parsedate_to_datetime(date).isoformat() if date else ""
+        except Exception:
+            timestamp = ""
+        sender = str(msg.get("From", ""))
+        subject = str(msg.get("Subject", ""))
+        body = _mbox_body(msg)
+        yield {
+            "id": f"mbox:{message_id or _content_id(sender, date, subject, body)}",
+            "sender": sender,
+            "subject": subject,
+            "body": body,
+            "timestamp": timestamp,
+            "image_url": None,
+            "message_id": message_id or None,
+            "in_reply_to": msg.get("In-Reply-To"),
+            "references": msg.get("References"),
+        }
+
+def _flush(chunk: List[Dict]) -> int:
+    """
+    Inserts a chunk through the batched save path and restores any results it carries.
+    Returns how many emails were new.
+    """
+    for email in chunk:
+        email.setdefault("image_url", None)
+        email.setdefault("sender", "")
+        email.setdefault("subject", "")
+        email.setdefault("body", "")
+        email.setdefault("timestamp", "")
+        # Exports carry the stored header column; save_emails rebuilds threads from it
+        email.setdefault("references", email.get("references_header"))
+    inserted = save_emails(chunk)
+    processed = [e for e in chunk if e.get("is_processed") and any(e.get(f) for f in RESULT_FIELDS)]
+    if processed:
+        update_email_results(processed)
+    return inserted
+
+def import_emails(path: str, fmt: Optional[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Loads a JSONL or mbox dump into the database in chunks, never holding the whole file in memory.
+    Returns how many emails were added; ones already stored or archived are skipped.
+    """
+    fmt = detect_format(path, fmt)
+    if fmt == "jsonl":
+        records = iter_jsonl(path)
+    elif fmt == "mbox":
+        records = iter_mbox(path)
+    else:
+        raise ValueError(f"Unsupported import format: {fmt}")
+
+    count = 0
+    chunk = []
+    for record in records:
+        if not record.get("id"):
+            continue
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            count += _flush(chunk)
+            chunk = []
+    if chunk:
+        count += _flush(chunk)
+    return count
@@ -0,0 +1,243 @@
+import os
+import queue
+import re
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from email.message import EmailMessage
+
+try:
+    import imap_tools  # noqa: F401
+except ImportError:
+    raise unittest.SkipTest("imap_tools is not installed")
+
+from src import db_utils
+from src.idle import IdleListener
+
+USERNAME = "user@example.com"
+
+def _make_message(uid: int) -> bytes:
+    msg = EmailMessage()
+    msg["From"] = "sender@example.com"
+    msg["To"] = USERNAME
+    msg["Subject"] = f"Message {uid}"
+    msg["Date"] = "Mon, 19 Oct 2026 10:00:00 +0000"
+    msg["Message-ID"] = f"<{uid}@example.com>"
+    msg.set_content(f"Body of message {uid}")
+    return msg.as_bytes().replace(b"\n", b"\r\n")
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """
+    Just enough IMAP4rev1 for IdleListener: LOGIN, SELECT, STATUS, UID SEARCH/FETCH and
+    IDLE. Like a real server, it announces new messages with EXISTS right away to clients
+    in IDLE and with the next command response to the others. drop_connections() closes
+    every open connection to simulate a network failure.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeImapHandler)
+        self.messages = {}
+        self.lock = threading.Lock()
+        self.handlers = set()
+        self.logins = 0
+
+    def add_message(self, uid: int):
+        with self.lock:
+            self.messages[uid] = _make_message(uid)
+            handlers = list(self.handlers)
+        for handler in handlers:
+            if handler.idling:
+                handler.report_exists()
+
+    def drop_connections(self):
+        with self.lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            handler.drop()
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.idling = False
+        self.reported = 0
+
+    def send(self, line):
+        with self.write_lock:
+            self.wfile.write(line if isinstance(line, bytes) else line.encode() + b"\r\n")
+            self.wfile.flush()
+
+    def report_exists(self):
+        """Sends EXISTS if messages were added since the client last heard the count."""
+        with self.server.lock:
+            count = len(self.server.messages)
+            if count == self.reported:
+                return
+            self.reported = count
+        try:
+            self.send(f"* {count} EXISTS")
+        except OSError:
+            pass
+
+    def drop(self):
+        try:
+            self.request.shutdown(2)
+        except OSError:
+            pass
+
+    def handle(self):
+        with self.server.lock:
+            self.server.handlers.add(self)
+        try:
+            self.send("* OK fake IMAP ready")
+            for raw in self.rfile:
+                line = raw.decode().strip()
+                if not line:
+                    continue
+                if self.idling:
+                    if line.upper() == "DONE":
+                        self.idling = False
+                        self.send(f"{self.idle_tag} OK IDLE terminated")
+                    continue
+                tag, command, *rest = line.split(" ", 2)
+                args = rest[0] if rest else ""
+                if not self.dispatch(tag, command.upper(), args):
+                    break
+        except OSError:
+            pass
+        finally:
+            with self.server.lock:
+                self.server.handlers.discard(self)
+
+    def dispatch(self, tag: str, command: str, args: str) -> bool:
+        messages = self.server.messages
+        if command == "CAPABILITY":
+            self.send("* CAPABILITY IMAP4rev1 IDLE UIDPLUS")
+        elif command == "LOGIN":
+            self.server.logins += 1
+        elif command == "LOGOUT":
+            self.send("* BYE")
+            self.send(f"{tag} OK LOGOUT completed")
+            return False
+        elif command in ("SELECT", "EXAMINE"):
+            self.reported = len(messages)
+            self.send(f"* {len(messages)} EXISTS")
+            self.send("* 0 RECENT")
+            self.send("* OK [UIDVALIDITY 1] UIDs valid")
+            self.send(f"* OK [UIDNEXT {max(messages, default=0) + 1}] Predicted next UID")
+            self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+            return True
+        elif command == "STATUS":
+            folder = args.split(" ")[0]
+            self.send(f"* STATUS {folder} (MESSAGES {len(messages)} UIDNEXT {max(messages, default=0) + 1} "
+                      f"UIDVALIDITY 1 UNSEEN 0 RECENT 0)")
+        elif command == "IDLE":
+            self.idle_tag = tag
+            self.idling = True
+            self.send("+ idling")
+            self.report_exists()
+            return True
+        elif command == "UID":
+            subcommand, _, params = args.partition(" ")
+            if subcommand.upper() == "SEARCH":
+                self.send("* SEARCH " + " ".join(str(uid) for uid in self._uids(params)))
+            elif subcommand.upper() == "FETCH":
+                uid_set = params.split(" ")[0]
+                for uid in self._uids(f"UID {uid_set}"):
+                    body = messages[uid]
+                    seq = sorted(messages).index(uid) + 1
+                    self.send(f"* {seq} FETCH (UID {uid} FLAGS () RFC822.SIZE {len(body)} BODY[] {{{len(body)}}}\r\n".encode()
+                              + body + b")\r\n")
+        elif command != "NOOP":
+            self.send(f"{tag} BAD unsupported command")
+            return True
+        self.report_exists()
+        self.send(f"{tag} OK {command} completed")
+        return True
+
+    def _uids(self, criteria: str):
+        uids = sorted(self.server.messages)
+        match = re.search(r"UID (\d+)(?::(\d+|\*))?", criteria, re.IGNORECASE)
+        if not match:
+            return uids
+        low = int(match.group(1))
+        if match.group(2) is None:
+            return [uid for uid in uids if uid == low]
+        # As on real servers, "N:*" also matches the newest message when all UIDs are below N
+        high = uids[-1] if match.group(2) == "*" else int(match.group(2))
+        low, high = min(low, high), max(low, high)
+        return [uid for uid in uids if low <= uid <= high]
+
+class IdleListenerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.old_db_path = db_utils.DB_PATH
+        db_utils.DB_PATH = os.path.join(self.tmpdir.name, "email_agent.db")
+        db_utils.init_db()
+
+        self.server = FakeImapServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.server.add_message(1)
+        self.server.add_message(2)
+
+        self.queue = queue.Queue()
+        self.listener = IdleListener(USERNAME, "secret", server="127.0.0.1", port=self.server.server_address[1],
+                                     use_ssl=False, new_email_queue=self.queue,
+                                     initial_backoff=0.1, max_backoff=0.2)
+
+    def tearDown(self):
+        self.listener.stop()
+        self.listener.join(timeout=5)
+        self.server.shutdown()
+        self.server.server_close()
+        db_utils.DB_PATH = self.old_db_path
+        self.tmpdir.cleanup()
+
+    def _wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if condition():
+                return True
+            time.sleep(0.02)
+        return False
+
+    def _stored_ids(self):
+        return sorted(email['id'] for email in db_utils.get_all_emails())
+
+    def test_new_mail_catch_up_and_reconnect(self):
+        self.listener.start()
+        self.assertTrue(self._wait_for(lambda: self.listener.last_uid == 2))
+        # The existing backlog is left to a regular fetch
+        self.assertEqual(self._stored_ids(), [])
+
+        self.server.add_message(3)
+        self.assertEqual(self.queue.get(timeout=5), [f"{USERNAME}:INBOX:3"])
+
+        # Mail arriving while the connection is down is fetched after reconnecting
+        self.server.drop_connections()
+        self.server.add_message(4)
+        self.assertEqual(self.queue.get(timeout=5), [f"{USERNAME}:INBOX:4"])
+        self.assertGreaterEqual(self.server.logins, 2)
+        self.assertEqual(self._stored_ids(), [f"{USERNAME}:INBOX:3", f"{USERNAME}:INBOX:4"])
+        self.assertTrue(self.queue.empty())
+
+    def test_stop_interrupts_idle(self):
+        # The listener sits in one long IDLE (default length); stop() must not wait for it to end
+        self.listener.start()
+        self.assertTrue(self._wait_for(lambda: self.listener.last_uid == 2))
+        self.assertTrue(self._wait_for(lambda: any(handler.idling for handler in self.server.handlers)))
+        started = time.monotonic()
+        self.listener.stop()
+        self.listener.join(timeout=5)
+        self.assertFalse(self.listener.is_alive())
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertIsNone(self.listener.last_error)
+
+if __name__ == "__main__":
+    unittest.main()
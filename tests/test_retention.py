@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+
+from src import db_utils
+from src.ingestion import fetch_emails_mock
+from src.retention import run_retention, restore_emails, get_archive_stats
+
+# Archives every email with a timestamp, processed or not
+ARCHIVE_ALL = [{"older_than_days": 0, "categories": None, "processed_only": False}]
+
+class ArchiveRefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.old_db_path = db_utils.DB_PATH
+        db_utils.DB_PATH = os.path.join(self.tmpdir.name, "email_agent.db")
+        db_utils.init_db()
+        fetch_emails_mock()
+        self.email_ids = sorted(email['id'] for email in db_utils.get_all_emails())
+
+    def tearDown(self):
+        db_utils.DB_PATH = self.old_db_path
+        self.tmpdir.cleanup()
+
+    def test_refetch_does_not_reinsert_archived_emails(self):
+        stats = run_retention(ARCHIVE_ALL)
+        self.assertEqual(stats['archived'], len(self.email_ids))
+        self.assertEqual(db_utils.get_all_emails(), [])
+
+        fetch_emails_mock()
+        self.assertEqual(db_utils.get_all_emails(), [])
+        self.assertEqual(db_utils.get_unprocessed_emails(), [])
+        self.assertEqual(get_archive_stats()['emails'], len(self.email_ids))
+
+    def test_restored_emails_are_saved_again(self):
+        run_retention(ARCHIVE_ALL)
+        self.assertEqual(restore_emails(self.email_ids[:2]), 2)
+        self.assertEqual(sorted(email['id'] for email in db_utils.get_all_emails()), self.email_ids[:2])
+
+        # Archiving a restored email again works the same way
+        run_retention(ARCHIVE_ALL)
+        fetch_emails_mock()
+        self.assertEqual(db_utils.get_all_emails(), [])
+
+if __name__ == "__main__":
+    unittest.main()